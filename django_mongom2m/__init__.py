@@ -9,6 +9,9 @@ from . import query
 # How much to show when query set is viewed in the Python shell
 REPR_OUTPUT_SIZE = 20
 
+# How many related objects to load from the database per $in query
+LOAD_CHUNK_SIZE = 1000
+
 # Sort of hackish, but they left me no choice! Without this, 'A' objects are
 # rejected for this field because it's not in "DJANGOTOOLBOX_FIELDS"
 django_mongodb_engine.query.DJANGOTOOLBOX_FIELDS += \
@@ -0,0 +1,201 @@
+from django.db import router, connections
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+try:
+    # ObjectId has been moved to bson.objectid in newer versions of PyMongo
+    from bson.objectid import ObjectId
+except ImportError:
+    from pymongo.objectid import ObjectId
+
+
+# Error code of MongoDB for duplicate keys
+DUPLICATE_KEY_ERROR = 11000
+
+
+class EdgeCollection(object):
+    """
+    The collection storing the relations of a MongoDBManyToManyField declared
+    with storage='collection', instead of a list in the host documents.
+
+    Every relation is one document (an edge) with the keys 'host_id',
+    'related_id' and 'position', the position of the related object in the
+    host's list. The collection is named after the host collection and the
+    field's column, and has compound indexes on (host_id, position) for the
+    forward lookups and a unique one on (related_id, host_id) for the reverse
+    lookups, so that both are indexed range scans.
+
+    Positions are allocated from a counter document per host (in the
+    '<name>_positions' collection) incremented atomically, so that
+    concurrent adds to the same host never get the same positions.
+    """
+    def __init__(self, field):
+        self.field = field
+        # Aliases of the databases whose indexes are ensured
+        self._indexed = set()
+
+    @property
+    def name(self):
+        return '%s_%s' % (self.field.model._meta.db_table, self.field.column)
+
+    def get_collection(self, using=None, write=False):
+        """
+        Return the edge collection. Its indexes are ensured by the first
+        write of the process, see ensure_indexes().
+        """
+        if using is None:
+            if write:
+                using = router.db_for_write(self.field.model)
+            else:
+                using = router.db_for_read(self.field.model)
+        if write and using not in self._indexed:
+            self.ensure_indexes(using)
+        return connections[using].get_collection(self.name)
+
+    def get_positions_collection(self, using=None):
+        """
+        Return the collection of the position counters of the hosts.
+        """
+        using = using or router.db_for_write(self.field.model)
+        return connections[using].get_collection(self.name + '_positions')
+
+    def ensure_indexes(self, using=None):
+        """
+        Create the indexes of the edge collection if they don't exist.
+        """
+        using = using or router.db_for_write(self.field.model)
+        collection = connections[using].get_collection(self.name)
+        collection.create_index([('host_id', ASCENDING),
+                                 ('position', ASCENDING)])
+        collection.create_index([('related_id', ASCENDING),
+                                 ('host_id', ASCENDING)], unique=True)
+        self._indexed.add(using)
+
+    def related_ids(self, host_pk, offset=0, limit=None, using=None):
+        """
+        Return the ObjectIds related to a host in order, optionally only a
+        window of them.
+        """
+        cursor = self.get_collection(using).find(
+                        {'host_id': ObjectId(host_pk)}, {'related_id': 1},
+                        sort=[('position', ASCENDING)], skip=offset)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return [edge['related_id'] for edge in cursor]
+
+    def related_ids_by_host(self, host_pks, using=None):
+        """
+        Return a dict of the ordered lists of related ObjectIds of many hosts,
+        keyed by host ObjectId, loaded with a single query.
+        """
+        host_pks = [ObjectId(pk) for pk in host_pks]
+        related_ids = dict((pk, []) for pk in host_pks)
+        cursor = self.get_collection(using).find(
+                        {'host_id': {'$in': host_pks}},
+                        {'host_id': 1, 'related_id': 1},
+                        sort=[('host_id', ASCENDING), ('position', ASCENDING)])
+        for edge in cursor:
+            related_ids[edge['host_id']].append(edge['related_id'])
+        return related_ids
+
+    def host_ids(self, related_pks, using=None):
+        """
+        Return the ObjectIds of the hosts related to any of the given ids.
+        """
+        related_pks = [ObjectId(pk) for pk in related_pks]
+        spec = {'related_id': {'$in': related_pks}}
+        return self.get_collection(using).distinct('host_id', spec)
+
+    def count(self, host_pk, using=None):
+        return self.get_collection(using).count_documents(
+                                            {'host_id': ObjectId(host_pk)})
+
+    def contains(self, host_pk, related_pk, using=None):
+        return self.get_collection(using).find_one(
+                        {'related_id': ObjectId(related_pk),
+                         'host_id': ObjectId(host_pk)}, {'_id': 1}) is not None
+
+    def _reserve_positions(self, host_pk, count, using=None):
+        """
+        Atomically reserve count positions after the last one of the host,
+        and return the first one.
+        """
+        counters = self.get_positions_collection(using)
+        update = {'$inc': {'next': count}}
+        counter = counters.find_one_and_update(
+                        {'_id': host_pk}, update,
+                        return_document=ReturnDocument.AFTER)
+        if counter is None:
+            # First add since the counter was created, start after the edges
+            # stored without counter. $max is safe to run concurrently.
+            last = self.get_collection(using, write=True).find_one(
+                        {'host_id': host_pk}, {'position': 1},
+                        sort=[('position', DESCENDING)])
+            counters.update_one(
+                    {'_id': host_pk},
+                    {'$max': {'next': last['position'] + 1 if last else 0}},
+                    upsert=True)
+            counter = counters.find_one_and_update(
+                        {'_id': host_pk}, update,
+                        return_document=ReturnDocument.AFTER)
+        return counter['next'] - count
+
+    def add(self, host_pk, related_pks, using=None):
+        """
+        Insert the edges of the given ids after the last one of the host.
+        Ids already related to the host are ignored.
+        """
+        if not related_pks:
+            return
+        host_pk = ObjectId(host_pk)
+        collection = self.get_collection(using, write=True)
+        start = self._reserve_positions(host_pk, len(related_pks), using)
+        edges = [{'host_id': host_pk, 'related_id': ObjectId(pk),
+                  'position': start + offset}
+                 for offset, pk in enumerate(related_pks)]
+        try:
+            collection.insert_many(edges, ordered=False)
+        except BulkWriteError as e:
+            # Ignore the edges added in the meantime
+            if any(error['code'] != DUPLICATE_KEY_ERROR
+                   for error in e.details.get('writeErrors', ())):
+                raise
+
+    def remove(self, host_pk, related_pks, using=None):
+        if related_pks:
+            self.get_collection(using, write=True).delete_many(
+                    {'host_id': ObjectId(host_pk),
+                     'related_id': {'$in': [ObjectId(pk)
+                                            for pk in related_pks]}})
+
+    def clear(self, host_pk, using=None):
+        self.get_collection(using, write=True).delete_many(
+                                            {'host_id': ObjectId(host_pk)})
+
+    def delete_host(self, host_pk, using=None):
+        """
+        Remove the edges and the position counter of a deleted host.
+        """
+        self.clear(host_pk, using)
+        self.get_positions_collection(using).delete_one(
+                                            {'_id': ObjectId(host_pk)})
+
+    def sync(self, host_pk, related_pks, using=None):
+        """
+        Make the edges of the host match the given ids, by deleting the
+        edges of the ids not given and adding the missing ones after the
+        others. The edges of the ids kept are not rewritten, so that readers
+        never see a partial relation.
+        """
+        related_pks = [ObjectId(pk) for pk in related_pks]
+        stored = set(self.related_ids(host_pk, using=using))
+        wanted = set(related_pks)
+        self.remove(host_pk, list(stored - wanted), using)
+        self.add(host_pk, [pk for pk in related_pks if pk not in stored],
+                 using)
+
+    def remove_related(self, related_pks, using=None):
+        """
+        Remove the edges of the given related ids from all the hosts.
+        """
+        self.get_collection(using, write=True).delete_many(
+                {'related_id': {'$in': [ObjectId(pk) for pk in related_pks]}})
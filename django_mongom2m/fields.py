@@ -1,15 +1,67 @@
-from django.db import models
+import threading
+
+from django.db import models, router, connections
 from django.db.models.fields.related import add_lazy_relation, RelatedObject
 from django.db.models.query_utils import DeferredAttribute
+from django.db.models.signals import post_save, post_delete, class_prepared
 from django_mongodb_engine.query import A
 from djangotoolbox.fields import ListField, EmbeddedModelField
+try:
+    # ObjectId has been moved to bson.objectid in newer versions of PyMongo
+    from bson.objectid import ObjectId
+except ImportError:
+    from pymongo.objectid import ObjectId
 
 from .manager import (MongoDBManyToManyRel, MongoDBM2MRelatedManager,
-                      MongoDBM2MReverseDescriptor,
-                      MongoDBManyToManyRelationDescriptor)
+                      MongoDBM2MReverseDescriptor, MongoDBM2MDeferredAttribute,
+                      MongoDBManyToManyRelationDescriptor, lazy_manager_key)
+from .edges import EdgeCollection
+from .objectlist import RelatedEntry
 from .utils import create_through
 
 
+def DO_NOTHING(field, pks):
+    """
+    on_delete behavior leaving the ids of deleted related objects in the
+    host documents (the default). They're skipped when loading the objects,
+    see also remove_nonexists().
+    """
+    pass
+
+def PULL(field, pks):
+    """
+    on_delete behavior removing the ids of deleted related objects from all
+    the host documents with a single update_many.
+    """
+    field.pull_references(pks)
+
+# MongoDBManyToManyFields with an on_delete behavior, by related model
+_on_delete_fields = {}
+# Related models whose on_delete handlers are suspended by delete_and_pull()
+_suspended = threading.local()
+
+def delete_and_pull(queryset):
+    """
+    Delete all the objects of a QuerySet, and apply the on_delete behavior
+    of the MongoDBManyToManyFields referring to them once for all the deleted
+    ids, instead of once per deleted object.
+
+    Example:
+    >>> delete_and_pull(Category.objects.filter(title__startswith='old'))
+    """
+    model = queryset.model
+    pks = [ObjectId(pk) for pk in queryset.values_list('pk', flat=True)]
+    suspended = getattr(_suspended, 'models', set())
+    _suspended.models = suspended | set([model])
+    try:
+        queryset.filter(pk__in=pks).delete()
+    finally:
+        _suspended.models = suspended
+    if pks:
+        for field in _on_delete_fields.get(model, ()):
+            field.rel.on_delete(field, pks)
+
+
 class MongoDBManyToManyField(models.ManyToManyField, ListField):
     """
     A generic MongoDB many-to-many field that can store embedded copies of
@@ -32,17 +84,53 @@ class MongoDBManyToManyField(models.ManyToManyField, ListField):
     
     article.categories.all() - Returns all the categories that belong to the article
     category.article_set.all() - Returns all the articles that belong to the category
+
+    Related objects which are not embedded are loaded from the database with
+    $in queries of at most 'chunk_size' ids (defaults to LOAD_CHUNK_SIZE).
+
+    With atomic=True, add(), remove(), create() and clear() update only this
+    field's list in the database ($addToSet/$push, $pull and $set) instead of
+    saving the whole host model instance.
+
+    With embed=True and sync_embedded=True, saving a related object updates
+    its embedded copies in all the host documents with a single update_many.
+
+    on_delete sets what happens to the ids stored in the host documents when
+    a related object is deleted: DO_NOTHING (default) leaves them, PULL
+    removes them from all the hosts with a single update_many. Use
+    delete_and_pull() to delete a QuerySet with one update per field.
+
+    With storage='collection', the relations are not stored in the host
+    documents but as one document per relation in a separate edge collection
+    (see EdgeCollection), for relations too large for a list. add(), remove()
+    and clear() then insert or delete single edges, and the related objects
+    are loaded lazily. It can't be used with embed=True.
     """
     description = 'ManyToMany field with references and optional embedded objects'
     generate_reverse_relation = False
     requires_unique_target = False
     
-    def __init__(self, to, related_name=None, embed=False, *args, **kwargs):
+    def __init__(self, to, related_name=None, embed=False, chunk_size=None,
+                 atomic=False, sync_embedded=False, on_delete=DO_NOTHING,
+                 storage='inline', *args, **kwargs):
         # Call Field, not super, to skip Django's ManyToManyField extra stuff
         # we don't need
         self._mm2m_to_or_name = to
         self._mm2m_related_name = related_name
         self._mm2m_embed = embed
+        self._mm2m_chunk_size = chunk_size
+        self._mm2m_atomic = atomic
+        if sync_embedded and not embed:
+            raise ValueError("sync_embedded=True requires embed=True")
+        self._mm2m_sync_embedded = sync_embedded
+        self._mm2m_on_delete = on_delete
+        if storage not in ('inline', 'collection'):
+            raise ValueError("storage must be 'inline' or 'collection', "
+                             "got %r" % (storage,))
+        if storage == 'collection' and embed:
+            raise ValueError("storage='collection' can't be used with "
+                             "embed=True")
+        self._mm2m_storage = storage
         if embed:
             item_field = EmbeddedModelField(to)
         else:
@@ -52,13 +140,25 @@ class MongoDBManyToManyField(models.ManyToManyField, ListField):
     def contribute_after_resolving(self, field, to, model):
         # Setup the main relation helper
         self.rel = MongoDBManyToManyRel(self, to, self._mm2m_related_name,
-                                        self._mm2m_embed)
+                                        self._mm2m_embed,
+                                        self._mm2m_chunk_size,
+                                        self._mm2m_atomic,
+                                        self._mm2m_on_delete,
+                                        self._mm2m_storage)
         # The field's default value will be an empty MongoDBM2MRelatedManager
         # that's not connected to a model instance
         self.default = MongoDBM2MRelatedManager(self, self.rel,
                                                 self._mm2m_embed)
         self.rel.model = model
         self.rel.through = create_through(self, self.rel.model, self.rel.to)
+        if self._mm2m_storage == 'collection':
+            self.rel.edges = EdgeCollection(self)
+            uid = '%s_%s_%s' % (model._meta.app_label,
+                                model._meta.object_name, self.name)
+            post_save.connect(self._flush_edges, sender=model, weak=False,
+                              dispatch_uid='mongom2m_flush_edges_' + uid)
+            post_delete.connect(self._clear_edges, sender=model, weak=False,
+                                dispatch_uid='mongom2m_clear_edges_' + uid)
         # Determine related name automatically unless set
         if not self.rel.related_name:
             self.rel.related_name = model._meta.object_name.lower() + '_set'
@@ -71,11 +171,96 @@ class MongoDBManyToManyField(models.ManyToManyField, ListField):
         # admin/forms to work
         setattr(model, self.name,
                 MongoDBManyToManyRelationDescriptor(self, self.rel.through))
+        if self._mm2m_sync_embedded:
+            post_save.connect(self._sync_embedded_copies, sender=self.rel.to,
+                              weak=False,
+                              dispatch_uid='mongom2m_sync_%s_%s_%s' % (
+                                    model._meta.app_label,
+                                    model._meta.object_name, self.name))
+        if self._mm2m_on_delete is not DO_NOTHING:
+            _on_delete_fields.setdefault(self.rel.to, []).append(self)
+            post_delete.connect(self._on_related_delete, sender=self.rel.to,
+                                weak=False,
+                                dispatch_uid='mongom2m_delete_%s_%s_%s' % (
+                                    model._meta.app_label,
+                                    model._meta.object_name, self.name))
         #TODO: deprecated self.related used in django nonrel-1.6, remove later
         other = self.rel.to
         self.do_related_class(other, model)
 
 
+    def _sync_embedded_copies(self, sender, instance, created=False,
+                              **kwargs):
+        """
+        post_save handler of the related model when sync_embedded=True.
+        """
+        # A new object can't be embedded anywhere yet
+        if not created:
+            self.update_embedded_copies(instance)
+
+    def update_embedded_copies(self, instance):
+        """
+        Rewrite the embedded copies of a related model instance in all the
+        host documents referring to it, with a single update_many using array
+        filters on the server instead of re-saving every host.
+        """
+        pk = ObjectId(instance.pk)
+        pk_column = self.rel.to._meta.pk.column
+        connection = connections[router.db_for_write(self.model)]
+        # Convert the instance the same way it's embedded by the manager
+        manager = MongoDBM2MRelatedManager(self, self.rel, self.rel.embed)
+        value = manager.get_raw_value_embedded_instance(
+                                        RelatedEntry(pk, instance), connection)
+        collection = connection.get_collection(self.model._meta.db_table)
+        collection.update_many(
+                {'%s.%s' % (self.column, pk_column): pk},
+                {'$set': {'%s.$[e]' % self.column: value}},
+                array_filters=[{'e.%s' % pk_column: pk}])
+
+    def _on_related_delete(self, sender, instance, **kwargs):
+        """
+        post_delete handler of the related model when on_delete is set.
+        """
+        if sender not in getattr(_suspended, 'models', ()):
+            self.rel.on_delete(self, [ObjectId(instance.pk)])
+
+    def _flush_edges(self, sender, instance, **kwargs):
+        """
+        post_save handler of the host model with storage='collection', writing
+        the relations changed without being saved, e.g. added before the host
+        model instance was saved for the first time.
+        """
+        data = instance.__dict__
+        manager = data.get(self.attname) or \
+                  data.get(lazy_manager_key(self.attname))
+        if isinstance(manager, MongoDBM2MRelatedManager) and \
+           manager._edges_pending:
+            self.rel.edges.sync(instance.pk, manager.ids())
+            manager._edges_pending = False
+
+    def _clear_edges(self, sender, instance, **kwargs):
+        """
+        post_delete handler of the host model with storage='collection'.
+        """
+        if instance.pk is not None:
+            self.rel.edges.delete_host(instance.pk)
+
+    def pull_references(self, pks):
+        """
+        Remove the given related ids from all the host documents with a
+        single update_many.
+        """
+        if self.rel.edges is not None:
+            self.rel.edges.remove_related(pks)
+            return
+        pk_column = self.rel.to._meta.pk.column
+        pks = [ObjectId(pk) for pk in pks]
+        connection = connections[router.db_for_write(self.model)]
+        collection = connection.get_collection(self.model._meta.db_table)
+        collection.update_many(
+                {'%s.%s' % (self.column, pk_column): {'$in': pks}},
+                {'$pull': {self.column: {pk_column: {'$in': pks}}}})
+
     def do_related_class(self, other, cls):
         self.related = RelatedObject(other, cls, self)
 
@@ -151,13 +336,30 @@ class MongoDBManyToManyField(models.ManyToManyField, ListField):
 
         if not isinstance(value, MongoDBM2MRelatedManager) and \
            not isinstance(value, DeferredAttribute):
+            if value is None and self.rel.edges is not None:
+                # Stored in the edge collection, loaded when needed
+                return MongoDBM2MRelatedManager.lazy(self, None)
             manager = MongoDBM2MRelatedManager(self, self.rel, self.rel.embed)
             manager.to_python(value)
+            if self.rel.edges is not None:
+                # The assigned objects replace the edges on the next save
+                manager._edges_pending = True
             value = manager
         return value
 
 
+def _install_lazy_managers(sender, **kwargs):
+    """
+    class_prepared handler giving lazy managers to the deferred
+    MongoDBManyToManyFields of deferred model classes.
+    """
+    if not getattr(sender, '_deferred', False):
+        return
+    for field in sender._meta.fields:
+        if isinstance(field, MongoDBManyToManyField) and \
+           type(sender.__dict__.get(field.attname)) is DeferredAttribute:
+            setattr(sender, field.attname,
+                    MongoDBM2MDeferredAttribute(field.attname, sender))
 
-
-
-
+class_prepared.connect(_install_lazy_managers,
+                       dispatch_uid='mongom2m_install_lazy_managers')
@@ -0,0 +1,238 @@
+from django.db import models, router, connections
+try:
+    # ObjectId has been moved to bson.objectid in newer versions of PyMongo
+    from bson.objectid import ObjectId
+except ImportError:
+    from pymongo.objectid import ObjectId
+
+
+# How many host documents to scan per batch
+SCAN_BATCH_SIZE = 1000
+
+
+def get_m2m_field(label):
+    '''
+    return the MongoDBManyToManyField named by label
+
+    :param label: '<app_label>.<ModelName>.<field name>'
+    '''
+    from .fields import MongoDBManyToManyField
+    try:
+        app_label, model_name, field_name = label.split('.')
+    except ValueError:
+        raise ValueError("Expected '<app_label>.<ModelName>.<field>', got '%s'"
+                         % label)
+    model = models.get_model(app_label, model_name)
+    if model is None:
+        raise ValueError("Unknown model '%s.%s'" % (app_label, model_name))
+    field = model._meta.get_field(field_name)
+    if not isinstance(field, MongoDBManyToManyField):
+        raise ValueError("'%s' is not a MongoDBManyToManyField" % label)
+    return field
+
+def iter_host_batches(field, projection, batch_size=None, start_after=None,
+                      using=None):
+    '''
+    yield lists of raw host documents of a MongoDBManyToManyField, scanned by
+    _id range in batches so that scans can be resumed from any _id
+
+    :param field: the MongoDBManyToManyField
+    :param projection: fields of the host documents to fetch
+    :param batch_size: number of host documents per batch
+    :param start_after: only scan hosts with an _id greater than this one
+    :param using: db alias of the host model
+    '''
+    if field.rel.edges is not None:
+        raise ValueError("The relations of '%s.%s' are stored in an edge "
+                         "collection, not in the host documents"
+                         % (field.model._meta.object_name, field.name))
+    if batch_size is None:
+        batch_size = SCAN_BATCH_SIZE
+    using = using or router.db_for_write(field.model)
+    collection = connections[using].get_collection(field.model._meta.db_table)
+    last_id = ObjectId(start_after) if start_after else None
+    while True:
+        spec = {'_id': {'$gt': last_id}} if last_id else {}
+        batch = list(collection.find(spec, projection)
+                               .sort('_id', 1).limit(batch_size))
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]['_id']
+
+def iter_dangling_references(field, batch_size=None, start_after=None,
+                             dry_run=False, using=None):
+    '''
+    scan all the host documents of a MongoDBManyToManyField, and remove the
+    ids of related objects which don't exist anymore.
+
+    Per batch of hosts, the referenced ids are checked with $in queries of
+    up to the field's chunk_size ids on the related collection, and the
+    dangling ones are removed with one $pull update_many per chunk. Ids stored as raw ObjectIds or strings (e.g. migrated
+    from ListField(ForeignKey)) are checked and removed too. A report dict is
+    yielded after each batch, with keys: 'hosts' (hosts scanned), 'dangling'
+    (dangling ids found), 'hosts_changed' (hosts referring to them) and
+    'last_id' (the _id to resume after).
+
+    :param field: the MongoDBManyToManyField
+    :param batch_size: number of host documents per batch
+    :param start_after: resume the scan after this host _id
+    :param dry_run: only report, don't remove anything
+    :param using: db alias of the host model
+    '''
+    using = using or router.db_for_write(field.model)
+    pk_column = field.rel.to._meta.pk.column
+    chunk_size = field.rel.chunk_size
+    hosts = connections[using].get_collection(field.model._meta.db_table)
+    related = connections[router.db_for_read(field.rel.to)].get_collection(
+                                                field.rel.to._meta.db_table)
+    # The whole column is fetched, a projection on '<column>.id' would skip
+    # the raw ids
+    for batch in iter_host_batches(field, {field.column: 1}, batch_size,
+                                   start_after, using):
+        refs = {}
+        # Raw ObjectId or string values, pulled by value
+        raw_values = {}
+        for document in batch:
+            for value in document.get(field.column) or ():
+                if isinstance(value, dict) and pk_column in value:
+                    pk = ObjectId(value[pk_column])
+                elif isinstance(value, (ObjectId, basestring)):
+                    pk = ObjectId(value)
+                    raw_values.setdefault(pk, set()).add(value)
+                else:
+                    continue
+                refs.setdefault(pk, []).append(document['_id'])
+        dangling = []
+        changed_hosts = set()
+        # The ids are checked and removed by chunks of chunk_size, so that no
+        # query holds all the ids of the batch
+        pks = list(refs)
+        for start in xrange(0, len(pks), chunk_size):
+            chunk = pks[start:start + chunk_size]
+            exists_ids = set(obj['_id'] for obj in
+                             related.find({'_id': {'$in': chunk}}, {'_id': 1}))
+            chunk_dangling = [pk for pk in chunk if pk not in exists_ids]
+            chunk_hosts = set()
+            for pk in chunk_dangling:
+                chunk_hosts.update(refs[pk])
+            dangling.extend(chunk_dangling)
+            changed_hosts.update(chunk_hosts)
+            if not chunk_dangling or dry_run:
+                continue
+            spec = {'_id': {'$in': list(chunk_hosts)}}
+            hosts.update_many(spec, {'$pull': {field.column: {
+                                    pk_column: {'$in': chunk_dangling}}}})
+            dangling_values = [value for pk in chunk_dangling
+                               for value in raw_values.get(pk, ())]
+            if dangling_values:
+                hosts.update_many(spec, {'$pull': {field.column: {
+                                        '$in': dangling_values}}})
+        yield {'hosts': len(batch), 'dangling': dangling,
+               'hosts_changed': len(changed_hosts),
+               'last_id': batch[-1]['_id']}
+
+def remove_dangling_references(field, **kwargs):
+    '''
+    run iter_dangling_references() over all the hosts, and return the totals
+    as a dict with keys 'hosts', 'dangling' (distinct dangling ids),
+    'hosts_changed' and 'last_id'
+    '''
+    totals = {'hosts': 0, 'dangling': 0, 'hosts_changed': 0, 'last_id': None}
+    dangling = set()
+    for report in iter_dangling_references(field, **kwargs):
+        totals['hosts'] += report['hosts']
+        dangling.update(report['dangling'])
+        totals['hosts_changed'] += report['hosts_changed']
+        totals['last_id'] = report['last_id']
+    totals['dangling'] = len(dangling)
+    return totals
+
+def iter_migrate_references(field, batch_size=None, start_after=None,
+                            throttle=0, using=None):
+    '''
+    rewrite the stored value of a MongoDBManyToManyField in all the host
+    documents the way the field stores it now, e.g. after switching embed or
+    migrating from ListField(ForeignKey) / ListField(EmbeddedModelField).
+
+    Only the field's column of the hosts is fetched, scanned by _id range in
+    batches. The related objects of a batch are loaded with batched $in
+    queries when embedding, and embedded the way the manager embeds them.
+    The batch is written with one unordered bulk_write of $set on the column
+    only. A report dict is yielded after each batch, with keys 'hosts',
+    'hosts_changed', 'unmigrated' and 'last_id'. Ids of related objects not
+    found in db are kept as ids only. Entries without an id can't be
+    migrated, they're left unchanged and counted in 'unmigrated'.
+
+    :param field: the MongoDBManyToManyField
+    :param batch_size: number of host documents per batch
+    :param start_after: resume after this host _id
+    :param throttle: seconds to sleep between batches
+    :param using: db alias of the host model
+    '''
+    import time
+    from pymongo import UpdateOne
+    from .manager import MongoDBM2MRelatedManager
+    from .objectlist import RelatedEntry
+    from .utils import fetch_objects
+
+    using = using or router.db_for_write(field.model)
+    connection = connections[using]
+    pk_column = field.rel.to._meta.pk.column
+    hosts = connection.get_collection(field.model._meta.db_table)
+    manager = MongoDBM2MRelatedManager(field, field.rel, field.rel.embed)
+    for batch in iter_host_batches(field, {field.column: 1}, batch_size,
+                                   start_after, using):
+        entries_by_host = []
+        all_pks = set()
+        unmigrated = 0
+        for document in batch:
+            # ObjectIds of the related objects, or the values without id
+            entries = []
+            for value in document.get(field.column) or ():
+                pk = value.get(pk_column) if isinstance(value, dict) else value
+                if pk is None:
+                    unmigrated += 1
+                    entries.append(value)
+                else:
+                    entries.append(ObjectId(pk))
+                    all_pks.add(entries[-1])
+            entries_by_host.append((document, entries))
+
+        embedded = {}
+        if field.rel.embed and all_pks:
+            instances = fetch_objects(field.rel.to, all_pks,
+                                      using=router.db_for_read(field.rel.to),
+                                      chunk_size=field.rel.chunk_size)
+            for pk, instance in instances.iteritems():
+                embedded[pk] = manager.get_raw_value_embedded_instance(
+                                        RelatedEntry(pk, instance), connection)
+
+        requests = []
+        for document, entries in entries_by_host:
+            value = [(embedded.get(entry) or {pk_column: entry})
+                     if isinstance(entry, ObjectId) else entry
+                     for entry in entries]
+            if value != document.get(field.column):
+                requests.append(UpdateOne({'_id': document['_id']},
+                                          {'$set': {field.column: value}}))
+        if requests:
+            hosts.bulk_write(requests, ordered=False)
+        yield {'hosts': len(batch), 'hosts_changed': len(requests),
+               'unmigrated': unmigrated, 'last_id': batch[-1]['_id']}
+        if throttle:
+            time.sleep(throttle)
+
+def migrate_references(field, **kwargs):
+    '''
+    run iter_migrate_references() over all the hosts, and return the totals
+    as a dict with keys 'hosts', 'hosts_changed', 'unmigrated' and 'last_id'
+    '''
+    totals = {'hosts': 0, 'hosts_changed': 0, 'unmigrated': 0,
+              'last_id': None}
+    for report in iter_migrate_references(field, **kwargs):
+        totals['hosts'] += report['hosts']
+        totals['hosts_changed'] += report['hosts_changed']
+        totals['unmigrated'] += report['unmigrated']
+        totals['last_id'] = report['last_id']
+    return totals
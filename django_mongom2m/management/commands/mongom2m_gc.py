@@ -0,0 +1,65 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_mongom2m.maintenance import get_m2m_field, iter_dangling_references
+
+
+class Command(BaseCommand):
+    args = '<app_label.Model.field>'
+    help = ('Remove the ids of deleted related objects from all the host '
+            'documents of a MongoDBManyToManyField.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None,
+                    help='Number of host documents scanned per batch.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only report the dangling ids, remove nothing.'),
+        make_option('--resume-after', dest='resume_after', default=None,
+                    help='Resume the scan after this host _id.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File storing the last scanned host _id. The scan '
+                         'resumes from it if it exists.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: %s %s' % (__name__.split('.')[-1],
+                                                 self.args))
+        try:
+            field = get_m2m_field(args[0])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        start_after = options['resume_after']
+        checkpoint = options['checkpoint']
+        if not start_after and checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                start_after = f.read().strip() or None
+        if start_after:
+            self.stdout.write('Resuming after %s' % start_after)
+
+        hosts = hosts_changed = 0
+        dangling = set()
+        for report in iter_dangling_references(
+                            field, batch_size=options['batch_size'],
+                            start_after=start_after,
+                            dry_run=options['dry_run']):
+            hosts += report['hosts']
+            hosts_changed += report['hosts_changed']
+            if options['dry_run']:
+                for pk in report['dangling']:
+                    if pk not in dangling:
+                        self.stdout.write('Dangling id: %s' % pk)
+            elif checkpoint:
+                with open(checkpoint, 'w') as f:
+                    f.write(str(report['last_id']))
+            dangling.update(report['dangling'])
+            self.stdout.write('%d hosts scanned, last _id %s'
+                              % (hosts, report['last_id']))
+
+        self.stdout.write('%s %d dangling ids in %d of %d hosts' % (
+                'Found' if options['dry_run'] else 'Removed',
+                len(dangling), hosts_changed, hosts))
@@ -0,0 +1,60 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_mongom2m.maintenance import get_m2m_field, iter_migrate_references
+
+
+class Command(BaseCommand):
+    args = '<app_label.Model.field>'
+    help = ('Rewrite the stored value of a MongoDBManyToManyField in all the '
+            'host documents, e.g. after switching embed on or off.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None,
+                    help='Number of host documents written per batch.'),
+        make_option('--throttle', type='float', dest='throttle', default=0,
+                    help='Seconds to sleep between batches.'),
+        make_option('--resume-after', dest='resume_after', default=None,
+                    help='Resume the migration after this host _id.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File storing the last migrated host _id. The '
+                         'migration resumes from it if it exists.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: %s %s' % (__name__.split('.')[-1],
+                                                 self.args))
+        try:
+            field = get_m2m_field(args[0])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        start_after = options['resume_after']
+        checkpoint = options['checkpoint']
+        if not start_after and checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                start_after = f.read().strip() or None
+        if start_after:
+            self.stdout.write('Resuming after %s' % start_after)
+
+        hosts = hosts_changed = unmigrated = 0
+        for report in iter_migrate_references(
+                            field, batch_size=options['batch_size'],
+                            start_after=start_after,
+                            throttle=options['throttle']):
+            hosts += report['hosts']
+            hosts_changed += report['hosts_changed']
+            unmigrated += report['unmigrated']
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    f.write(str(report['last_id']))
+            self.stdout.write('%d hosts migrated, last _id %s'
+                              % (hosts, report['last_id']))
+
+        self.stdout.write('Rewrote %d of %d hosts' % (hosts_changed, hosts))
+        if unmigrated:
+            self.stdout.write('Left %d entries without id unchanged'
+                              % unmigrated)
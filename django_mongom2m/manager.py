@@ -1,8 +1,8 @@
 
-from django.db import models, router
-from django.db.models import Q
+from django.db import models, router, connections
+from django.db.models.query_utils import DeferredAttribute
 from django.db.models.signals import m2m_changed
-from .utils import get_exists_ids
+from .utils import get_exists_ids, fetch_objects, load_objects
 
 try:
     # ObjectId has been moved to bson.objectid in newer versions of PyMongo
@@ -10,8 +10,9 @@ try:
 except ImportError:
     from pymongo.objectid import ObjectId
 
-from .query import MongoDBM2MQuerySet, MongoDBM2MQueryError
-from .utils import replace_Q, combine_A
+from .objectlist import LazyRelatedEntry, RelatedEntry, RelatedObjectList
+from .query import MongoDBM2MQuerySet, MongoDBM2MHostQuerySet
+from .utils import get_field_by_name_or_attname, instance_from_document
 import warnings
 
 
@@ -19,6 +20,11 @@ class MongoDBM2MReverseManager(object):
     """
     This manager is attached to the other side of M2M relationships
     and will return query sets that fetch related objects.
+
+    count(), exists(), ids() and values_list() are run by the database on the
+    host collection (an indexed query on '<column>.id'), without loading the
+    host model instances. With storage='collection', all() returns a query
+    set paging through the edges instead of a $in of every host id.
     """
     def __init__(self, rel_field, model, field, rel, embed):
         self.rel_field = rel_field
@@ -31,18 +37,243 @@ class MongoDBM2MReverseManager(object):
         """
         Retrieve all related objects.
         """
+        if self.rel.edges is not None:
+            # Iterated, counted and sliced by host_id ranges of the edges
+            return MongoDBM2MQuerySet(self.rel, self.model, None,
+                                      use_cached=True, manager=self,
+                                      to=self.model)
         name = self.field.column + '.' + self.rel.model._meta.pk.column
         pk = ObjectId(self.rel_field.pk)
         return self.model._default_manager.raw_query({name:pk})
 
+    def _get_collection(self):
+        """
+        Return the collection of the host model.
+        """
+        connection = connections[router.db_for_read(self.model)]
+        return connection.get_collection(self.model._meta.db_table)
+
+    def _host_spec(self):
+        """
+        Return the query matching the host documents related to the instance.
+        With storage='collection', the hosts are found from the edges instead.
+        """
+        return {'%s.%s' % (self.field.column, self.rel.to._meta.pk.column):
+                ObjectId(self.rel_field.pk)}
+
+    def _edge_spec(self):
+        """
+        Return the query matching the edges of the instance, with
+        storage='collection'.
+        """
+        return {'related_id': ObjectId(self.rel_field.pk)}
+
+    def count(self):
+        """
+        Return the number of related objects, counted by the database.
+        """
+        if self.rel.edges is not None:
+            return self.rel.edges.get_collection().count_documents(
+                                                        self._edge_spec())
+        return self._get_collection().count_documents(self._host_spec())
+
+    def exists(self):
+        if self.rel.edges is not None:
+            return self.rel.edges.get_collection().find_one(
+                                self._edge_spec(), {'_id': 1}) is not None
+        return self._get_collection().find_one(self._host_spec(),
+                                               {'_id': 1}) is not None
+
+    def ids(self):
+        """
+        Return a list of the ObjectIds of all the related objects.
+        """
+        if self.rel.edges is not None:
+            return self.rel.edges.host_ids([self.rel_field.pk])
+        return [document['_id'] for document in
+                self._get_collection().find(self._host_spec(), {'_id': 1})]
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Return an iterator over the values of the given fields of the related
+        objects, fetched with a projection on these fields only. Works like
+        QuerySet.values_list, including 'flat'.
+        """
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s'
+                    % (list(kwargs),))
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when values_list is called with more than one field.")
+        return self._iter_values_list(fields, flat)
+
+    def _iter_values_list(self, fields, flat):
+        opts = self.model._meta
+        if fields:
+            fields = [get_field_by_name_or_attname(self.model, name)
+                      for name in fields]
+        else:
+            fields = opts.fields
+        connection = connections[router.db_for_read(self.model)]
+        columns = [field.column if field is not opts.pk else '_id'
+                   for field in fields]
+        for document in self._iter_documents(dict.fromkeys(columns, 1),
+                                             self.rel.chunk_size):
+            row = tuple(connection.ops.value_from_db(document.get(column),
+                                                     field)
+                        for field, column in zip(fields, columns))
+            yield row[0] if flat else row
+
+    def iterator(self, batch_size=None, projection=None):
+        """
+        Iterate over the related objects without caching them, straight from
+        a pymongo cursor fetching batch_size documents at a time (defaults to
+        the field's chunk_size), so that memory use is bounded.
+
+        :param batch_size: number of documents per batch
+        :param projection: names of the only fields to fetch, the others are
+                deferred. By default, all the fields but the
+                MongoDBManyToManyFields are fetched. Deferred
+                MongoDBManyToManyFields are loaded when they're accessed.
+        """
+        if batch_size is None:
+            batch_size = self.rel.chunk_size
+        opts = self.model._meta
+        if projection is None:
+            fields = [field for field in opts.fields
+                      if not isinstance(field.rel, MongoDBManyToManyRel)]
+        else:
+            fields = [opts.pk] + [get_field_by_name_or_attname(self.model,
+                                                               name)
+                                  for name in projection]
+        deferred = [field.attname for field in opts.fields
+                    if field not in fields]
+        columns = dict.fromkeys(('_id' if field is opts.pk else field.column
+                                 for field in fields), 1)
+        using = router.db_for_read(self.model)
+        for document in self._iter_documents(columns, batch_size):
+            yield instance_from_document(self.model, document, using,
+                                         deferred)
+
+    def _iter_documents(self, columns, batch_size):
+        """
+        Yield the projected host documents related to the instance.
+        """
+        collection = self._get_collection()
+        if self.rel.edges is None:
+            for document in collection.find(self._host_spec(), columns,
+                                            batch_size=batch_size):
+                yield document
+            return
+        # The host ids are read from the edges by batches
+        edges = self.rel.edges.get_collection().find(
+                    self._edge_spec(), {'host_id': 1}, batch_size=batch_size)
+        host_ids = []
+        for edge in edges:
+            host_ids.append(edge['host_id'])
+            if len(host_ids) == batch_size:
+                for document in collection.find({'_id': {'$in': host_ids}},
+                                                columns):
+                    yield document
+                host_ids = []
+        if host_ids:
+            for document in collection.find({'_id': {'$in': host_ids}},
+                                            columns):
+                yield document
+
+    def _get_entry(self, pk):
+        """
+        Return the internal object (RelatedEntry) of the related object with
+        the given ObjectId pk, or None.
+        """
+        if self.rel.edges is not None:
+            if not self.rel.edges.contains(pk, self.rel_field.pk):
+                return None
+        else:
+            spec = {'$and': [self._host_spec(), {'_id': pk}]}
+            if self._get_collection().find_one(spec, {'_id': 1}) is None:
+                return None
+        try:
+            return RelatedEntry(pk, self.model._default_manager.get(pk=pk))
+        except self.model.DoesNotExist:
+            return None
+
+    @property
+    def objects(self):
+        """
+        The internal objects (RelatedEntry) of all the related objects, with
+        only their pks, read by batches of chunk_size. Only used to evaluate
+        filter(), exclude() and order_by() of the query sets of all().
+        """
+        return RelatedObjectList(
+                    RelatedEntry(document['_id'], None) for document in
+                    self._iter_documents({'_id': 1}, self.rel.chunk_size))
+
+    def _find_window(self, after=None, offset=0, limit=None):
+        """
+        Return the internal objects (RelatedEntry) of the related objects in
+        pk order, with a pk greater than after, from offset and up to limit
+        objects, and the list of the pks scanned (including the edges of
+        hosts not found, with storage='collection').
+        """
+        manager = self.model._default_manager
+        if self.rel.edges is not None:
+            # Range scan on the (related_id, host_id) index of the edges
+            spec = self._edge_spec()
+            if after is not None:
+                spec['host_id'] = {'$gt': after}
+            cursor = self.rel.edges.get_collection().find(
+                        spec, {'host_id': 1}, sort=[('host_id', 1)],
+                        skip=offset, limit=limit or 0)
+            host_ids = [edge['host_id'] for edge in cursor]
+            if not host_ids:
+                return [], []
+            hosts = dict((ObjectId(obj.pk), obj) for obj in
+                         manager.filter(pk__in=host_ids))
+            return ([RelatedEntry(pk, hosts[pk]) for pk in host_ids
+                     if pk in hosts], host_ids)
+        spec = self._host_spec()
+        if after is not None:
+            spec = {'$and': [spec, {'_id': {'$gt': after}}]}
+        stop = None if limit is None else offset + limit
+        window = [RelatedEntry(ObjectId(obj.pk), obj) for obj in
+                  manager.raw_query(spec).order_by('pk')[offset:stop]]
+        return window, [obj.pk for obj in window]
+
+    def _load_window(self, offset, limit=None):
+        """
+        Return the internal objects (RelatedEntry) of the related objects in
+        pk order, from offset and up to limit objects. Used to slice the
+        query sets, iterating uses _iter_windows().
+        """
+        return self._find_window(offset=offset, limit=limit)[0]
+
+    def _iter_windows(self, size):
+        """
+        Yield the internal objects (RelatedEntry) of all the related objects
+        in pk order, in lists of up to size objects. Every window is fetched
+        by a range query after the last pk of the previous one, so that no
+        index entries are skipped over.
+        """
+        after = None
+        while True:
+            window, scanned = self._find_window(after=after, limit=size)
+            if window:
+                yield window
+            if len(scanned) < size:
+                return
+            after = scanned[-1]
+
     def _relationship_query_set(self, model, to_instance, model_module_name,
                                 to_module_name):
         """
         Emulate an intermediate 'through' relationship query set.
+
+        The related objects are not loaded here: the query set is counted by
+        the database, and loads them in pages when sliced or iterated.
         """
-        objects = [{'pk':ObjectId(obj.pk), 'obj':obj} for obj in self.all()]
         return MongoDBM2MQuerySet(
-                self.rel, self.rel.to, objects, use_cached=True,
+                self.rel, self.rel.to, None, use_cached=True, manager=self,
                 appear_as_relationship=(model, None, to_instance,
                                         model_module_name, to_module_name))
 
@@ -59,28 +290,197 @@ class MongoDBM2MReverseDescriptor(object):
         return MongoDBM2MReverseManager(instance, self.model, self.field,
                                         self.rel, self.embed)
 
+def lazy_manager_key(attname):
+    """
+    Key of the lazy manager of a deferred field in the instance's __dict__.
+    """
+    return '_%s_lazy_manager' % attname
+
+
 class MongoDBM2MRelatedManager(object):
     """
     This manager manages the related objects stored in a MongoDBManyToManyField.
     They can be embedded or stored as relations (ObjectIds) only.
-    Internally, we store the objects as dicts that contain keys pk and obj.
-    The obj key is None when the object has not yet been loaded from the db.
+    Internally, we store the objects as RelatedEntry objects that have the
+    attributes pk and obj. The obj attribute is None when the object has not
+    yet been loaded from the db. The entries are kept in a RelatedObjectList,
+    an ordered set indexed by pk which is shared by copies until modified.
+
+    The manager tracks whether its objects changed since they were loaded
+    from (or last converted for) the database, so that saving the host model
+    doesn't convert an unchanged list again.
+
+    When the field was deferred while loading the host model instance (e.g.
+    Article.objects.defer('categories')), the manager is lazy: its objects
+    are only loaded from the host document when needed. count(), ids() and
+    windows of all() (see all(offset, limit)) are then served by the
+    database without loading the whole list.
     """
     def __init__(self, field, rel, embed, objects=[], model_instance=None):
         self.model_instance = model_instance
         self.field = field
         self.rel = rel
         self.embed = embed
-        self.objects = list(objects) # make copy of the list to avoid problems
+        # make (copy-on-write) copy of the list to avoid problems
+        self.objects = RelatedObjectList(objects)
+        # The database value of the objects, reused while not dirty
+        self._db_value = None
+        self._dirty = True
+        # Whether the objects changed without writing the edges, with
+        # storage='collection'
+        self._edges_pending = False
+
+    @classmethod
+    def lazy(cls, field, model_instance):
+        """
+        Create a manager loading its objects from the document of the saved
+        model_instance when they're first needed.
+        """
+        manager = cls(field, field.rel, field.rel.embed,
+                      model_instance=model_instance)
+        manager._objects = None
+        return manager
+
+    def _get_objects(self):
+        if self._objects is None:
+            self._load_from_db()
+        return self._objects
+
+    def _set_objects(self, objects):
+        self._objects = objects
+        if objects is not None and self.model_instance is not None:
+            # The field isn't deferred anymore once loaded, so that it's
+            # saved with the model instance from now on
+            data = self.model_instance.__dict__
+            key = lazy_manager_key(self.field.attname)
+            if data.get(key) is self:
+                del data[key]
+                data[self.field.attname] = self
+
+    objects = property(_get_objects, _set_objects)
+
+    def _get_entry(self, pk):
+        """
+        Return the internal object (RelatedEntry) of the related object with
+        the given ObjectId pk, or None, without loading all the objects.
+        """
+        if self.is_loaded():
+            return self.objects.get(pk)
+        if pk in self:
+            return RelatedEntry(pk, None)
+        return None
+
+    def is_loaded(self):
+        """
+        Whether the objects have been loaded from the host document.
+        """
+        return self._objects is not None
+
+    def _get_collection(self, using=None):
+        """
+        Return the collection of the model instance.
+        """
+        if using is None:
+            using = router.db_for_write(self.model_instance)
+        return connections[using].get_collection(
+                                        self.model_instance._meta.db_table)
+
+    def _host_spec(self):
+        return {'_id': ObjectId(self.model_instance.pk)}
+
+    def _values_from_db(self, values):
+        """
+        Convert the raw values of the field from the host document the way
+        they're converted when the host model instance is loaded.
+        """
+        connection = connections[router.db_for_read(self.model_instance)]
+        return connection.ops.value_from_db(values or [], self.field)
+
+    def _load_from_db(self):
+        """
+        Load all the objects of a lazy manager from the host document, or
+        from the edge collection.
+        """
+        if self.rel.edges is not None:
+            self.objects = RelatedObjectList(
+                    RelatedEntry(pk, None) for pk in
+                    self.rel.edges.related_ids(self.model_instance.pk))
+            return
+        document = self._get_collection().find_one(self._host_spec(),
+                                                   {self.field.column: 1})
+        self.to_python(self._values_from_db(
+                                (document or {}).get(self.field.column)))
+
+    def _load_window(self, offset, limit=None):
+        """
+        Return the internal objects (RelatedEntry) of the list slice
+        [offset:offset + limit]. If the objects are not loaded, only the
+        window is fetched from the host document with $slice.
+        """
+        if self.is_loaded():
+            stop = None if limit is None else offset + limit
+            return list(self.objects[offset:stop])
+        if limit == 0:
+            return []
+        if self.rel.edges is not None:
+            return [RelatedEntry(pk, None) for pk in
+                    self.rel.edges.related_ids(self.model_instance.pk,
+                                               offset, limit)]
+        array = {'$ifNull': ['$' + self.field.column, []]}
+        if limit is None:
+            # $slice needs a positive number of elements
+            limit = {'$max': [{'$size': array}, 1]}
+        pipeline = [{'$match': self._host_spec()},
+                    {'$project': {'_id': 0,
+                                  'window': {'$slice': [array, offset, limit]}}}]
+        values = [document['window']
+                  for document in self._get_collection().aggregate(pipeline)]
+        return [self.to_python_embedded_instance(value) for value in
+                self._values_from_db(values[0] if values else [])]
+
+    def _iter_windows(self, size):
+        """
+        Yield the internal objects (RelatedEntry) of the list in order, in
+        windows of up to size objects (see _load_window()).
+        """
+        offset = 0
+        while True:
+            window = self._load_window(offset, size)
+            if window:
+                yield window
+            if len(window) < size:
+                return
+            offset += size
 
     def _with_model_instance(self, model_instance):
         """
         Create a new copy of this manager for a specific model instance. This
         is called when the field is being accessed through a model instance.
         """
-        return MongoDBM2MRelatedManager(
+        manager = MongoDBM2MRelatedManager(
                         self.field, self.rel, self.embed,
-                        self.objects, model_instance=model_instance)
+                        self._objects if self.is_loaded() else (),
+                        model_instance=model_instance)
+        if not self.is_loaded():
+            manager._objects = None
+        manager._db_value = self._db_value
+        manager._dirty = self._dirty
+        manager._edges_pending = self._edges_pending
+        return manager
+
+    def is_dirty(self):
+        """
+        Whether objects were added or removed since the objects were loaded
+        from the database.
+        """
+        return self._dirty
+
+    def mark_dirty(self):
+        """
+        Force the objects to be converted again on the next save, e.g. after
+        modifying embedded instances in place.
+        """
+        self._dirty = True
 
     def __call__(self):
         """
@@ -89,6 +489,16 @@ class MongoDBM2MRelatedManager(object):
         return MongoDBM2MRelatedManager(self.field, self.rel, self.embed, self.objects)
 
     def count(self):
+        if not self.is_loaded():
+            if self.rel.edges is not None:
+                return self.rel.edges.count(self.model_instance.pk)
+            # Only the size of the list is sent by the database
+            pipeline = [{'$match': self._host_spec()},
+                        {'$project': {'size': {'$size': {
+                            '$ifNull': ['$' + self.field.column, []]}}}}]
+            for document in self._get_collection().aggregate(pipeline):
+                return document['size']
+            return 0
         return len(self.objects)
 
     def add(self, *objs, **kwargs):
@@ -104,11 +514,18 @@ class MongoDBM2MRelatedManager(object):
                 behavior is not the same as Django either because Django doesn't
                 save the whole model object, so that's why this is optional.
                 Swings and Roundabouts.
+                If the field is declared with atomic=True and the model has
+                already been saved, only the field is updated in the database
+                with a single $addToSet/$push instead of saving the model.
         """
         auto_save = kwargs.pop('auto_save', True)
         using = router.db_for_write(self.model_instance if self.model_instance
                                                         else self.field.model)
+        # The edges of a lazy manager are added without loading its objects,
+        # the ones already stored are skipped by the unique index
+        lazy_edges = self._writes_lazy_edges(auto_save)
         add_objs = []
+        add_pks = set()
         for obj in objs:
             if isinstance(obj, (ObjectId, basestring)):
                 # It's an ObjectId
@@ -118,11 +535,12 @@ class MongoDBM2MRelatedManager(object):
                 # It's a model object
                 pk = ObjectId(obj.pk)
                 instance = obj
-            if not pk in (obj['pk'] for obj in self.objects):
-                add_objs.append({'pk':pk, 'obj':instance})
+            if pk not in add_pks and (lazy_edges or pk not in self.objects):
+                add_pks.add(pk)
+                add_objs.append(RelatedEntry(pk, instance))
 
         # Calculate list of object ids that are being added
-        add_obj_ids = [str(obj['pk']) for obj in add_objs]
+        add_obj_ids = [str(obj.pk) for obj in add_objs]
 
         # Send pre_add signal (instance should be Through instance but it's the
         #  manager instance for now)
@@ -131,8 +549,11 @@ class MongoDBM2MRelatedManager(object):
                          pk_set=add_obj_ids, using=using)
 
         # Commit the add
-        for obj in add_objs:
-            self.objects.append({'pk':obj['pk'], 'obj':obj['obj']})
+        if not lazy_edges:
+            for obj in add_objs:
+                self.objects.append(obj)
+            if add_objs:
+                self._dirty = True
 
         # Send post_add signal (instance should be Through instance but it's
         # the manager instance for now)
@@ -140,8 +561,14 @@ class MongoDBM2MRelatedManager(object):
                          action='post_add', reverse=False, model=self.rel.to,
                          pk_set=add_obj_ids, using=using)
 
-        if auto_save:
-            self.model_instance.save()
+        if auto_save and self._can_update_atomically():
+            if add_objs:
+                self._add_atomically(add_objs, using)
+        else:
+            if add_objs:
+                self._edges_pending = True
+            if auto_save:
+                self.model_instance.save()
 
     def create(self, **kwargs):
         """
@@ -163,8 +590,10 @@ class MongoDBM2MRelatedManager(object):
                          action='pre_remove', reverse=False, model=self.rel.to,
                          pk_set=removed_obj_ids)
 
-        # Commit the remove
-        self.objects = [obj for obj in self.objects if str(obj['pk']) not in removed_obj_ids]
+        # Commit the remove, the objects of a lazy manager stay unloaded
+        if self.is_loaded() and \
+           self.objects.remove_pks([ObjectId(pk) for pk in removed_obj_ids]):
+            self._dirty = True
 
         # Send the post_remove signal
         m2m_changed.send(self.rel.through, instance=self.model_instance,
@@ -184,47 +613,92 @@ class MongoDBM2MRelatedManager(object):
         """
         auto_save = kwargs.pop('auto_save', True)
 
-        obj_ids = set([ObjectId(obj) if isinstance(obj, (ObjectId, basestring))
-                                     else ObjectId(obj.pk) for obj in objs])
-
-        # Calculate list of object ids that will be removed
-        removed_obj_ids = [str(obj['pk']) for obj in self.objects if obj['pk'] in obj_ids]
+        obj_ids = [ObjectId(obj) if isinstance(obj, (ObjectId, basestring))
+                                 else ObjectId(obj.pk) for obj in objs]
+
+        # Calculate list of object ids that will be removed, checked with
+        # indexed lookups of the edges if the objects are not loaded
+        lazy_edges = self._writes_lazy_edges(auto_save)
+        removed_obj_ids = []
+        seen = set()
+        for pk in obj_ids:
+            if pk not in seen and (pk in self if lazy_edges
+                                   else pk in self.objects):
+                seen.add(pk)
+                removed_obj_ids.append(str(pk))
         self._remove_by_id_strings(removed_obj_ids)
 
         if auto_save:
-            self.model_instance.save()
+            self._save_removed(removed_obj_ids)
+        elif removed_obj_ids:
+            self._edges_pending = True
 
     def remove_nonexists(self, **kwargs):
         """
         remove objects not exist in db
 
+        Not needed for fields with on_delete=PULL, unless they contain ids
+        stored before on_delete was set.
+
         :param auto_save: See add() above for description
         """
         auto_save = kwargs.pop('auto_save', True)
 
-        exists_ids = [obj['_id'] for obj in get_exists_ids(self.model_instance, self.rel, self.objects)]
-        removed_obj_ids = [str(obj['pk']) for obj in self.objects if (not obj['pk'] in exists_ids)]
+        exists_ids = set(obj['_id'] for obj in get_exists_ids(self.model_instance, self.rel, self.objects))
+        removed_obj_ids = [str(obj.pk) for obj in self.objects if (not obj.pk in exists_ids)]
         self._remove_by_id_strings(removed_obj_ids)
 
         if auto_save:
-            self.model_instance.save()
+            self._save_removed(removed_obj_ids)
+        elif removed_obj_ids:
+            self._edges_pending = True
 
 
     def reload_from_db(self, **kwargs):
         """
         Reload all objs from db, and remove objs not exists
 
-        A short cut using all(use_cached=False),.
-        TODO: dev a more effiecient method
+        All objs are fetched with batched $in queries and refreshed in place.
+        Only the objs not existing anymore are removed, so the remove signals
+        are only sent for them.
+
+        :param auto_save: See add() above for description. If the model
+                instance was already saved, only the field is updated: the
+                refreshed embedded copies are $set, or the removed ids are
+                $pull-ed when not embedding.
         """
         auto_save = kwargs.pop('auto_save', True)
 
-        all_objects_from_db = [obj for obj in self.all(use_cached=False)]
-        self.clear(auto_save=False)
-        self.add(*all_objects_from_db, auto_save=False)
-
+        instances = fetch_objects(self.rel.to, self.objects.pks(),
+                                  using=router.db_for_read(self.rel.to),
+                                  chunk_size=self.rel.chunk_size)
+        for obj in self.objects:
+            instance = instances.get(obj.pk)
+            if instance is not None:
+                obj.obj = instance
+        removed_obj_ids = [str(obj.pk) for obj in self.objects
+                           if obj.pk not in instances]
+        if removed_obj_ids:
+            self._remove_by_id_strings(removed_obj_ids)
+        if self.embed:
+            # The embedded copies have been refreshed
+            self._dirty = True
+
+        if not auto_save or self.model_instance.pk is None:
+            if removed_obj_ids:
+                self._edges_pending = True
         if auto_save:
-            self.model_instance.save()
+            if self.model_instance.pk is None:
+                self.model_instance.save()
+            elif self.embed:
+                using = router.db_for_write(self.model_instance)
+                connection = connections[using]
+                values = [self.get_raw_value_embedded_instance(obj, connection)
+                          for obj in self.objects]
+                self._update_atomically({'$set': {self.field.column: values}},
+                                        using)
+            elif removed_obj_ids:
+                self._pull_ids(removed_obj_ids)
 
     def clear(self, auto_save=True):
         """
@@ -234,7 +708,7 @@ class MongoDBM2MRelatedManager(object):
         :param auto_save: See add() above for description
         """
         # Calculate list of object ids that will be removed
-        removed_obj_ids = [str(obj['pk']) for obj in self.objects]
+        removed_obj_ids = [str(obj.pk) for obj in self.objects]
 
         # Send the pre_clear signal
         m2m_changed.send(self.rel.through, instance=self.model_instance,
@@ -242,40 +716,145 @@ class MongoDBM2MRelatedManager(object):
                          pk_set=removed_obj_ids)
 
         # Commit the clear
-        self.objects = []
+        self.objects = RelatedObjectList()
+        self._dirty = True
 
         # Send the post_clear signal
         m2m_changed.send(self.rel.through, instance=self.model_instance,
                          action='post_clear', reverse=False, model=self.rel.to,
                          pk_set=removed_obj_ids)
 
-        if auto_save:
+        if auto_save and self._can_update_atomically():
+            if self.rel.edges is not None:
+                self.rel.edges.clear(self.model_instance.pk)
+            else:
+                self._update_atomically({'$set': {self.field.column: []}})
+        else:
+            self._edges_pending = True
+            if auto_save:
+                self.model_instance.save()
+
+    def _can_update_atomically(self):
+        """
+        Whether changes can be written with a single update of the field
+        (atomic=True), or of the edges (storage='collection'), instead of
+        saving the whole model instance.
+        """
+        return ((self.rel.atomic or self.rel.edges is not None) and
+                self.model_instance.pk is not None)
+
+    def _writes_lazy_edges(self, auto_save):
+        """
+        Whether changes are written to the edges (storage='collection') of a
+        manager whose objects are not loaded, without loading them.
+        """
+        return (self.rel.edges is not None and not self.is_loaded() and
+                auto_save and self._can_update_atomically())
+
+    def _update_atomically(self, update, using=None):
+        """
+        Apply a MongoDB update to the model instance's document only, the
+        other fields of the model are not saved.
+        """
+        self._get_collection(using).update_one(self._host_spec(), update)
+
+    def _add_atomically(self, add_objs, using):
+        """
+        Push the added objects to the field in the database. Plain ids are
+        added with $addToSet. Embedded copies can differ from the stored ones,
+        so each one is pushed by an update guarded on its pk not being in the
+        list yet, in a single ordered bulk_write.
+        """
+        if self.rel.edges is not None:
+            self.rel.edges.add(self.model_instance.pk,
+                               [obj.pk for obj in add_objs], using)
+            return
+        connection = connections[using]
+        column = self.field.column
+        if not self.embed:
+            values = [self.get_raw_value_embedded_instance(obj, connection)
+                      for obj in add_objs]
+            self._update_atomically({'$addToSet': {column: {'$each': values}}},
+                                    using)
+            return
+        from pymongo import UpdateOne
+        load_objects(self.rel.to, add_objs, using=using,
+                     chunk_size=self.rel.chunk_size)
+        pk_path = '%s.%s' % (column, self.rel.to._meta.pk.column)
+        requests = []
+        for obj in add_objs:
+            spec = self._host_spec()
+            spec[pk_path] = {'$ne': obj.pk}
+            value = self.get_raw_value_embedded_instance(obj, connection)
+            requests.append(UpdateOne(spec, {'$push': {column: value}}))
+        self._get_collection(using).bulk_write(requests)
+
+    def _save_removed(self, removed_obj_ids):
+        """
+        Save the model instance after removing objects, or $pull the removed
+        ids from the field only when atomic=True.
+        """
+        if self._can_update_atomically():
+            if removed_obj_ids:
+                self._pull_ids(removed_obj_ids)
+        else:
+            if removed_obj_ids:
+                self._edges_pending = True
             self.model_instance.save()
 
+    def _pull_ids(self, removed_obj_ids):
+        """
+        $pull the given ids from the field in the database only.
+        """
+        if self.rel.edges is not None:
+            self.rel.edges.remove(self.model_instance.pk, removed_obj_ids)
+            return
+        pk_column = self.rel.to._meta.pk.column
+        ids = [ObjectId(pk) for pk in removed_obj_ids]
+        self._update_atomically({'$pull': {self.field.column: {
+                                    pk_column: {'$in': ids}}}})
+
     def __contains__(self, obj):
         """
         Helper to enable 'object in container' by comparing IDs.
         """
         if hasattr(obj, 'pk'): obj = obj.pk
         elif hasattr(obj, 'id'): obj = obj.id
-        return ObjectId(obj) in [ObjectId(o['pk']) for o in self.objects]
+        if not self.is_loaded() and self.rel.edges is not None:
+            return self.rel.edges.contains(self.model_instance.pk, obj)
+        if not self.is_loaded():
+            spec = self._host_spec()
+            spec['%s.%s' % (self.field.column,
+                            self.rel.to._meta.pk.column)] = ObjectId(obj)
+            return self._get_collection().find_one(spec, {'_id': 1}) is not None
+        return ObjectId(obj) in self.objects
 
     def __iter__(self):
         """
         Iterator is used by Django admin's ModelMultipleChoiceField.
+        Referred instances are loaded from db in batches and kept in memory,
+        objects not found in db are skipped like in all().
         """
-        for obj in self.objects:
-            if not obj['obj']:
-                # Load referred instance from db and keep in memory
-                obj['obj'] = self.rel.to.objects.get(pk=obj['pk'])
-            yield obj['obj']
+        return iter(self.all())
 
-    def all(self, **kwargs):
+    def all(self, offset=None, limit=None, **kwargs):
         """
         Return all the related objects as a query set. If embedding
         is enabled, returns embedded objects. Otherwise the query set
         will retrieve the objects from the database as needed.
+
+        With offset and/or limit, only the objects of that window of the list
+        are returned, e.g. for pagination. When the objects are not loaded
+        (lazy manager), only the window is fetched from the host document.
+        Slicing the query set of a lazy manager does the same.
         """
+        if offset is not None or limit is not None:
+            return MongoDBM2MQuerySet(self.rel, self.rel.to,
+                                      self._load_window(offset or 0, limit),
+                                      **kwargs)
+        if not self.is_loaded():
+            return MongoDBM2MQuerySet(self.rel, self.rel.to, None,
+                                      manager=self, **kwargs)
         return MongoDBM2MQuerySet(self.rel, self.rel.to, self.objects,
                                   **kwargs)
 
@@ -283,7 +862,17 @@ class MongoDBM2MRelatedManager(object):
         """
         Return a list of ObjectIds of all the related objects.
         """
-        return [obj['pk'] for obj in self.objects]
+        if not self.is_loaded() and self.rel.edges is not None:
+            return self.rel.edges.related_ids(self.model_instance.pk)
+        if not self.is_loaded():
+            # Only fetch the ids, not the embedded objects
+            pk_column = self.rel.to._meta.pk.column
+            document = self._get_collection().find_one(self._host_spec(),
+                            {'%s.%s' % (self.field.column, pk_column): 1})
+            return [ObjectId(value[pk_column]) for value in
+                    (document or {}).get(self.field.column) or ()
+                    if isinstance(value, dict) and pk_column in value]
+        return self.objects.pks()
 
     def objs(self):
         """
@@ -302,16 +891,20 @@ class MongoDBM2MRelatedManager(object):
         """
         Convert a single embedded instance value stored in the database to an
         object we can store in the internal objects list.
+
+        Embedded model instances are not built here: the entry keeps the
+        value and builds the instance when it's accessed, so that operations
+        on ids only never pay for it.
         """
         if isinstance(embedded_instance, ObjectId):
             # It's an object id, probably from a ListField(ForeignKey) migration
-            return {'pk': embedded_instance, 'obj': None}
+            return RelatedEntry(embedded_instance, None)
         elif isinstance(embedded_instance, basestring):
             # Assume it's a string formatted object id, probably from a
             # ListField(ForeignKey) migration
-            return {'pk': ObjectId(embedded_instance), 'obj': None}
+            return RelatedEntry(ObjectId(embedded_instance), None)
 
-        elif isinstance(embedded_instance, tuple):
+        if isinstance(embedded_instance, tuple):
             # This is the typical path for embedded instances (embed=True)
             # The tuples is format: (<embedded model class>, <kwarg dict>)
             cls, values = embedded_instance
@@ -325,36 +918,27 @@ class MongoDBM2MRelatedManager(object):
                 if isinstance(values, tuple):
                     # In some versions of django-toolbox, 'values' is a tuple.
                     values = dict(values)
+                    embedded_instance = (cls, values)
                 # Otherwise it's been embedded previously
-                instance = cls(**values)
-                return {'pk': ObjectId(instance.pk), 'obj': instance}
+                pk = values.get(cls._meta.pk.attname)
+                return LazyRelatedEntry(ObjectId(pk), embedded_instance,
+                                        self._decode_embedded_instance)
 
         elif self.embed:
             # Try to load the embedded object contents if possible
+            column = self.rel.to._meta.pk.column
             if isinstance(embedded_instance, dict):
-                # Convert the embedded value from dict to model
-                data = {}
-                for field in self.rel.to._meta.fields:
-                    try:
-                        data[str(field.attname)] = \
-                                                embedded_instance[field.column]
-                    except KeyError:
-                        pass
-
-                # If we only got the id, give up to avoid creating an
-                # invalid/empty model instance
-                if len(data) <= 1:
-                    column = self.rel.to._meta.pk.column
-                    return {'pk': ObjectId(embedded_instance[column]),
-                            'obj': None}
-                else:
-                    # Otherwise create the model instance from the fields
-                    obj = self.rel.to(**data)
-                    # Make sure the pk in the model instance is a string
-                    # (not ObjectId) to be compatible with django-mongodb-engine
-                    if isinstance(obj.pk, ObjectId):
-                        obj.pk = str(obj.pk)
-                    return {'pk': ObjectId(obj.pk), 'obj': obj}
+                pk = ObjectId(embedded_instance[column])
+                known = [field for field in self.rel.to._meta.fields
+                         if field.column in embedded_instance]
+                if len(known) <= 1:
+                    # If we only got the id, give up to avoid creating an
+                    # invalid/empty model instance
+                    return RelatedEntry(pk, None)
+                # Otherwise the model instance is created from the fields
+                # when needed
+                return LazyRelatedEntry(pk, embedded_instance,
+                                        self._decode_embedded_instance)
             else:
                 # Assume it's already a model
                 obj = embedded_instance
@@ -362,16 +946,45 @@ class MongoDBM2MRelatedManager(object):
                 # with django-mongodb-engine
                 if isinstance(obj.pk, ObjectId):
                     obj.pk = str(obj.pk)
-                return {'pk': ObjectId(obj.pk), 'obj': obj}
+                return RelatedEntry(ObjectId(obj.pk), obj)
         else:
             # No embedded value, only ObjectId
             if isinstance(embedded_instance, dict):
                 # Get the id value from the dict
                 column = self.rel.to._meta.pk.column
-                return {'pk': ObjectId(embedded_instance[column]), 'obj': None}
+                return RelatedEntry(ObjectId(embedded_instance[column]), None)
             else:
                 # Assume it's already a model
-                return {'pk': ObjectId(embedded_instance.pk), 'obj': None}
+                return RelatedEntry(ObjectId(embedded_instance.pk), None)
+
+    def _decode_embedded_instance(self, embedded_instance):
+        """
+        Build the model instance of an embedded value kept by a
+        LazyRelatedEntry. Returns None if the value only holds the id.
+        """
+        if isinstance(embedded_instance, tuple):
+            cls, values = embedded_instance
+            return cls(**values)
+
+        # Convert the embedded value from dict to model
+        data = {}
+        for field in self.rel.to._meta.fields:
+            try:
+                data[str(field.attname)] = embedded_instance[field.column]
+            except KeyError:
+                pass
+
+        # If we only got the id, give up to avoid creating an
+        # invalid/empty model instance
+        if len(data) <= 1:
+            return None
+        # Otherwise create the model instance from the fields
+        obj = self.rel.to(**data)
+        # Make sure the pk in the model instance is a string
+        # (not ObjectId) to be compatible with django-mongodb-engine
+        if isinstance(obj.pk, ObjectId):
+            obj.pk = str(obj.pk)
+        return obj
 
     def to_python(self, values):
         """
@@ -381,22 +994,46 @@ class MongoDBM2MRelatedManager(object):
         if isinstance(values, models.Model):
             # Single value given as parameter
             values = [values]
-        self.objects = [self.to_python_embedded_instance(value)
-                        for value in values]
+        self.objects = RelatedObjectList(
+                        self.to_python_embedded_instance(value)
+                        for value in values)
+        # The loaded value can be saved back as is if it's already stored
+        # the way we store it. Otherwise (e.g. migrations) it's converted on
+        # the next save.
+        self._db_value = None
+        self._dirty = True
+        column = self.rel.to._meta.pk.column
+        if self.embed:
+            # The raw embedded values are kept in the order of the objects,
+            # unless duplicates were dropped
+            if len(self.objects) == len(values) and \
+               all(isinstance(obj, LazyRelatedEntry) for obj in self.objects):
+                self._db_value = list(values)
+                self._dirty = False
+        elif all(isinstance(value, dict) and len(value) == 1 and
+                 isinstance(value.get(column), ObjectId) for value in values):
+            self._db_value = list(values)
+            self._dirty = False
 
     def get_db_prep_value_embedded_instance(self, obj, connection):
         """
         Convert an internal object value to database representation.
         """
         if not obj: return None
-        pk = obj['pk']
+        pk = obj.pk
         if not self.embed:
             # If we're not embedding, store only the ID
             return {self.rel.to._meta.pk.column: pk}
-        if not obj['obj']:
-            # Retrieve the object from db for storing as embedded data
-            obj['obj'] = self.rel.to.objects.get(pk=pk)
-        embedded_instance = obj['obj']
+        raw = getattr(obj, 'raw', None)
+        if raw is not None:
+            # The embedded value loaded from the db was never accessed, so
+            # store it back without building the model instance
+            return self.get_db_prep_value_raw_instance(raw, connection)
+        if not obj.obj:
+            # Retrieve the object from db for storing as embedded data, if it
+            # was not loaded with the others by get_db_prep_value
+            obj.obj = self.rel.to.objects.get(pk=pk)
+        embedded_instance = obj.obj
         values = {}
 
         for field in embedded_instance._meta.fields:
@@ -407,12 +1044,75 @@ class MongoDBM2MRelatedManager(object):
         # values[self.rel.to._meta.pk] = ObjectId(values[self.rel.to._meta.pk])
         return values
 
+    def get_db_prep_value_raw_instance(self, embedded_instance, connection):
+        """
+        Convert an embedded value loaded from the database (kept by a
+        LazyRelatedEntry) back to database representation.
+        """
+        if isinstance(embedded_instance, tuple):
+            cls, values = embedded_instance
+            return dict((field, field.get_db_prep_save(
+                                        values[field.attname],
+                                        connection=connection))
+                        for field in cls._meta.fields
+                        if field.attname in values)
+        # Values of a dict are already stored as they come from the database
+        return dict((field, embedded_instance[field.column])
+                    for field in self.rel.to._meta.fields
+                    if field.column in embedded_instance)
+
+    def get_raw_value_embedded_instance(self, obj, connection):
+        """
+        Convert an internal object value to the document stored in MongoDB,
+        for updates that skip the model's save().
+        """
+        values = self.get_db_prep_value_embedded_instance(obj, connection)
+        if not values or not self.embed:
+            return values
+        raw = dict((field.column, connection.ops.value_for_db(value, field))
+                   for field, value in values.iteritems())
+        # The pk is always stored as an ObjectId
+        raw[self.rel.to._meta.pk.column] = obj.pk
+        return raw
+
     def get_db_prep_value(self, connection, prepared=False):
         """Convert the Django model instances managed by this manager into a
         special list that can be stored in MongoDB.
+
+        The converted value is reused as long as the objects are not changed.
+        With embed=True the raw values loaded from the database are kept
+        instead, and only the embedded instances accessed since then are
+        converted again in case they were modified.
+
+        Nothing is stored in the host document with storage='collection'.
         """
-        values = [self.get_db_prep_value_embedded_instance(obj, connection)
-                  for obj in self.objects]
+        if self.rel.edges is not None:
+            return None
+        if not self.embed:
+            if self._db_value is None or self._dirty:
+                self._db_value = [
+                    self.get_db_prep_value_embedded_instance(obj, connection)
+                    for obj in self.objects]
+                self._dirty = False
+            return self._db_value
+        raw_values = self._db_value if not self._dirty else None
+        # Retrieve all the objects not loaded yet for storing as embedded
+        # data at once, instead of one query per object
+        load_objects(self.rel.to,
+                     [obj for obj in self.objects
+                      if getattr(obj, 'raw', None) is None and not obj.obj],
+                     using=connection.alias, chunk_size=self.rel.chunk_size)
+        values = []
+        for i, obj in enumerate(self.objects):
+            if raw_values is not None and getattr(obj, 'raw', None) is not None:
+                values.append(self.get_db_prep_value_raw_instance(
+                                        raw_values[i], connection))
+            else:
+                values.append(self.get_db_prep_value_embedded_instance(
+                                        obj, connection))
+        if raw_values is None:
+            self._db_value = None
+            self._dirty = False
         return values
 
 
@@ -463,10 +1163,13 @@ class MongoDBManyToManyRelationDescriptor(object):
         argument is 'pk'. The reason for this is because related models are
         stored by pk.
 
-        Warning: Only the first call to this method will actually behave
-                 correctly. If you string multiple calls to filter together, the
-                 remaining filters after the first will all act on the fields
-                 of the host model.
+        The result is a MongoDBM2MHostQuerySet: further calls to filter() and
+        exclude() are M2M-aware too, and conditions on the fields of the host
+        model are added with filter_host() and exclude_host(). All of them are
+        compiled into a single MongoDB query:
+
+        >>> Host.m2m.filter(name="foo").exclude(name="bar") \\
+        ...     .filter_host(published=True).order_by('-date').limit(10)
 
         Example:
         >>>class M2MModel(models.Model):
@@ -494,52 +1197,28 @@ class MongoDBManyToManyRelationDescriptor(object):
         I very much dislike this solution, but a better solution eludes me
         right now. In order to get the behavior Django has, django-nonrel or
         djangotoolbox need to be changed to support manytomany fields.
-        """
-        def raise_query_error():
-            raise MongoDBM2MQueryError(
-                "Invalid query paramaters: '%s; %s'. M2M Fields not using the "
-                "'embed=True' option can only filter on 'pk' because only "
-                "the related model's pk is stored for non-embedded M2Ms. "
-                "Note: M2M fields that are converted to 'embed=True' do "
-                "not convert the stored values automatically. Every "
-                "instance of the host-model must be re-saved after "
-                "converting the field." % (args, kwargs))
-
-        embedded = self.field._mm2m_embed
-        column = self.field.column
-
-        updated_args = []
-        # Iterate over the arguments and replace them with A objects
-        for field in args:
-            if isinstance(field, Q):
-                # Some args may be Qs. This function replaces the Q children
-                # with A() objects.
-                status = replace_Q(field, column,
-                                    ["pk"] if not embedded else None)
-                if status:
-                    updated_args.append(field)
-                else:
-                    raise_query_error()
-            else:
-                # Anything else should be tuples of two items
-                updated_args.append(
-                    (self.field.column, combine_A(field[0], field[1])))
 
-        updated_kwargs = []
-        # Iterate over the kwargs and combine them into A objects
-        for field, value in kwargs.iteritems():
-            if not embedded and field != 'pk':
-                raise_query_error()
+        Per-element matching:
+        By default, every condition is matched separately, so that
+        filter(title="a", slug="b") matches hosts where one embedded object
+        has the title and another one the slug. With elem_match=True, all the
+        conditions are compiled into a single $elemMatch (see
+        compile_elem_match()), so that they apply to the same object, and
+        double-underscore lookups can be used:
 
-            # Have to build Q objects because all the arguments will have the
-            # same key in the kwargs otherwise
-            updated_kwargs.append(Q(**{column: combine_A(field, value)}))
-
-        query_args = updated_args + updated_kwargs
+        >>> Host.m2m.filter(name__startswith="foo", count__gt=3,
+        ...                 elem_match=True)
+        """
+        queryset = self.all()
         if negate:
-            return self.field.model.objects.exclude(*query_args)
-        else:
-            return self.field.model.objects.filter(*query_args)
+            return queryset.exclude(*args, **kwargs)
+        return queryset.filter(*args, **kwargs)
+
+    def all(self):
+        """Return a MongoDBM2MHostQuerySet of all the host model instances,
+        to chain queries on.
+        """
+        return MongoDBM2MHostQuerySet(self.field)
 
     def filter(self, *args, **kwargs):
         """See _filter_or_exclude() above for description"""
@@ -549,23 +1228,82 @@ class MongoDBManyToManyRelationDescriptor(object):
         """See _filter_or_exclude() above for description"""
         return self._filter_or_exclude(True, *args, **kwargs)
 
+    def filter_host(self, *args, **kwargs):
+        """See MongoDBM2MHostQuerySet.filter_host()"""
+        return self.all().filter_host(*args, **kwargs)
+
     def get(self, *args, **kwargs):
         """Return a single object matching the query.
         See _filter_or_exclude() above for more details.
         """
-        results = self.filter(*args, **kwargs)
-        num = len(results)
-        if num == 1:
-            return results[0]
-        elif num < 1:
-            raise self.field.model.DoesNotExist(
-                            "%s matching query does not exist."
-                            % self.field.model._meta.object_name)
-        else:
-            raise self.field.model.MultipleObjectsReturned(
-                        "get() returned more than one %s -- it returned %s! "
-                        "Lookup parameters were %s"
-                        % (self.field.model._meta.object_name, num, kwargs))
+        return self.all().get(*args, **kwargs)
+
+    def filter_all(self, objs):
+        """
+        Return the host model instances related to all the given objects
+        (model instances or ids), with a single $all query.
+
+        >>> Article.tags.filter_all([tag1, tag2])
+        """
+        return self.all().filter_all(objs)
+
+    def filter_any(self, objs):
+        """
+        Return the host model instances related to any of the given objects
+        (model instances or ids), with a single $in query.
+        """
+        return self.all().filter_any(objs)
+
+    def filter_none(self, objs):
+        """
+        Return the host model instances related to none of the given objects
+        (model instances or ids), with a single $nin query.
+        """
+        return self.all().filter_none(objs)
+
+    def filter_size(self, size=None, gt=None, gte=None, lt=None, lte=None):
+        """
+        Return the host model instances by number of related objects.
+        See MongoDBM2MHostQuerySet.filter_size().
+
+        >>> Article.categories.filter_size(0) # no categories
+        >>> Article.tags.filter_size(gt=5) # more than 5 tags
+        """
+        return self.all().filter_size(size, gt, gte, lt, lte)
+
+
+class MongoDBM2MDeferredAttribute(DeferredAttribute):
+    """
+    Replaces Django's DeferredAttribute for a deferred MongoDBManyToManyField
+    in deferred model classes (QuerySet.defer()/only()). Instead of loading
+    the whole field with a query when it's accessed, it returns a lazy
+    MongoDBM2MRelatedManager. The field is still skipped when saving the
+    model instance if it was never accessed.
+    """
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        data = instance.__dict__
+        manager = data.get(self.field_name)
+        if manager is None:
+            # The lazy manager is kept under another name until it's loaded,
+            # so that the field stays deferred when the instance is saved
+            key = lazy_manager_key(self.field_name)
+            manager = data.get(key)
+            if manager is None:
+                field = instance._meta.get_field(self.field_name)
+                manager = MongoDBM2MRelatedManager.lazy(field, instance)
+                data[key] = manager
+            return manager
+        if not manager.model_instance:
+            manager = manager._with_model_instance(instance)
+            data[self.field_name] = manager
+        return manager
+
+    def __set__(self, instance, value):
+        field = instance._meta.get_field(self.field_name)
+        instance.__dict__.pop(lazy_manager_key(self.field_name), None)
+        instance.__dict__[self.field_name] = field.to_python(value)
 
 
 class MongoDBManyToManyRel(object):
@@ -574,7 +1312,8 @@ class MongoDBManyToManyRel(object):
     It's accessed by Django admin/forms in various contexts, and we also
     use it internally. We try to simulate what's needed by Django.
     """
-    def __init__(self, field, to, related_name, embed):
+    def __init__(self, field, to, related_name, embed, chunk_size=None,
+                 atomic=False, on_delete=None, storage='inline'):
         self.model = None # added later from contribute_to_class
         self.through = None # added later from contribute_to_class
         #for django.core.management.validation
@@ -583,6 +1322,19 @@ class MongoDBManyToManyRel(object):
         self.to = to
         self.related_name = related_name
         self.embed = embed
+        if chunk_size is None:
+            from . import LOAD_CHUNK_SIZE
+            chunk_size = LOAD_CHUNK_SIZE
+        # Max number of ids per $in query when loading related objects
+        self.chunk_size = chunk_size
+        # Write add/remove/clear with single updates instead of saving
+        self.atomic = atomic
+        # What to do with the stored ids of deleted related objects
+        self.on_delete = on_delete
+        # Where the relations are stored, and the EdgeCollection storing
+        # them with storage='collection' (added later from the field)
+        self.storage = storage
+        self.edges = None
         self.field_name = self.to._meta.pk.name
         # Required for Django admin/forms to work.
         self.multiple = True
@@ -0,0 +1,184 @@
+class RelatedEntry(object):
+    """
+    A related object of a MongoDBManyToManyField: its pk as an ObjectId and
+    its model instance. obj is None when the instance has not yet been loaded
+    from the db. Slots keep the entries small for fields with many relations.
+    """
+    __slots__ = ('pk', '_obj')
+
+    def __init__(self, pk, obj=None):
+        self.pk = pk
+        self._obj = obj
+
+    def _get_obj(self):
+        return self._obj
+
+    def _set_obj(self, obj):
+        self._obj = obj
+
+    obj = property(_get_obj, _set_obj)
+
+    def __getitem__(self, key):
+        # Backwards compatibility with the {'pk':..., 'obj':...} dicts
+        # previously used for the entries
+        if key not in ('pk', 'obj'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.pk)
+
+
+class LazyRelatedEntry(RelatedEntry):
+    """
+    A RelatedEntry of an embedded object loaded from the database. The raw
+    embedded value is kept and the model instance is only built by 'decode'
+    the first time obj is accessed.
+    """
+    __slots__ = ('_raw', '_decode')
+
+    def __init__(self, pk, raw, decode):
+        self.pk = pk
+        self._obj = None
+        self._raw = raw
+        self._decode = decode
+
+    def _get_obj(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._obj = self._decode(raw)
+        return self._obj
+
+    def _set_obj(self, obj):
+        self._raw = None
+        self._obj = obj
+
+    obj = property(_get_obj, _set_obj)
+
+    @property
+    def raw(self):
+        """
+        The embedded value loaded from the database, None once decoded.
+        """
+        return self._raw
+
+
+class RelatedObjectList(object):
+    """
+    Insertion-ordered set of the internal objects (RelatedEntry) managed by
+    MongoDBM2MRelatedManager and MongoDBM2MQuerySet, indexed by the ObjectId
+    pk of the objects.
+
+    Membership tests, lookups by pk, appends and removals are O(1). Removed
+    objects leave a hole in the ordered list, the holes are compacted lazily
+    when an index is needed or when they outnumber the objects.
+
+    Copies are copy-on-write: a copy shares the storage of the original list
+    until one of them is modified. The entries themselves are always shared.
+    """
+    def __init__(self, objects=()):
+        if isinstance(objects, RelatedObjectList):
+            self._list = objects._list
+            self._index = objects._index
+            self._holes = objects._holes
+            self._shared = objects._shared = True
+        else:
+            self._list = []
+            self._index = {}
+            self._holes = 0
+            self._shared = False
+            self.extend(objects)
+
+    def _detach(self):
+        """
+        Make a private copy of the storage before modifying it, if shared.
+        """
+        if self._shared:
+            self._list = list(self._list)
+            self._index = dict(self._index)
+            self._shared = False
+
+    def _compact(self):
+        """
+        Remove the holes left by removed objects and reindex the positions.
+        """
+        if self._holes:
+            # New storage is built, so it's never shared
+            self._list = [obj for obj in self._list if obj is not None]
+            self._index = dict((obj.pk, position)
+                               for position, obj in enumerate(self._list))
+            self._holes = 0
+            self._shared = False
+
+    def __len__(self):
+        return len(self._list) - self._holes
+
+    def __iter__(self):
+        for obj in self._list:
+            if obj is not None:
+                yield obj
+
+    def __getitem__(self, key):
+        self._compact()
+        return self._list[key]
+
+    def __contains__(self, pk):
+        return pk in self._index
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def get(self, pk, default=None):
+        """
+        Return the object with the given ObjectId pk.
+        """
+        position = self._index.get(pk)
+        if position is None:
+            return default
+        return self._list[position]
+
+    def append(self, obj):
+        """
+        Add an object at the end, unless an object with the same pk is
+        already present. Returns True if the object was added.
+        """
+        if obj.pk in self._index:
+            return False
+        self._detach()
+        self._index[obj.pk] = len(self._list)
+        self._list.append(obj)
+        return True
+
+    def extend(self, objects):
+        for obj in objects:
+            self.append(obj)
+
+    def remove_pks(self, pks):
+        """
+        Remove the objects with the given ObjectId pks, unknown pks are
+        ignored. Returns the list of removed objects.
+        """
+        removed = []
+        for pk in pks:
+            if pk not in self._index:
+                continue
+            self._detach()
+            position = self._index.pop(pk)
+            removed.append(self._list[position])
+            self._list[position] = None
+            self._holes += 1
+        if self._holes > len(self._list) // 2:
+            self._compact()
+        return removed
+
+    def clear(self):
+        self._list = []
+        self._index = {}
+        self._holes = 0
+        self._shared = False
+
+    def pks(self):
+        """
+        Return the list of ObjectId pks in order.
+        """
+        return [obj.pk for obj in self]
@@ -0,0 +1,259 @@
+from django.db import router, connections
+from .objectlist import RelatedEntry, RelatedObjectList
+from .utils import (load_objects, get_field_by_name_or_attname,
+                    instance_from_document)
+try:
+    # ObjectId has been moved to bson.objectid in newer versions of PyMongo
+    from bson.objectid import ObjectId
+except ImportError:
+    from pymongo.objectid import ObjectId
+from bson.son import SON
+
+
+def prefetch_mongom2m(hosts, *field_names, **kwargs):
+    """
+    Load the related objects of MongoDBManyToManyFields for many host model
+    instances at once, the MongoDB equivalent of Django's prefetch_related.
+
+    The ids stored in all the hosts are collected and loaded with one
+    deduplicated $in query (split in chunks of 'chunk_size' ids) per related
+    model. The loaded instances are shared by all the hosts referring to them.
+    Objects already cached (e.g. embedded) are not loaded again.
+
+    Only supported kwargs are 'using' and 'chunk_size'.
+
+    Example:
+    >>> articles = prefetch_mongom2m(Article.objects.all()[:200],
+    ...                              'categories')
+    >>> for article in articles:
+    ...     article.categories.all() # no more queries
+
+    :param hosts: iterable of host model instances, e.g. a QuerySet
+    :param field_names: names of the MongoDBManyToManyFields to prefetch
+    :returns: list of the host instances
+    """
+    from .fields import MongoDBManyToManyField
+
+    using = kwargs.pop('using', None)
+    chunk_size = kwargs.pop('chunk_size', None)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments to prefetch_mongom2m: %s'
+                        % (list(kwargs),))
+    hosts = list(hosts)
+
+    # The edges of fields with storage='collection' are loaded with one query
+    # per field for all the hosts
+    for name in field_names:
+        lazy_managers = {}
+        for host in hosts:
+            field = host._meta.get_field(name)
+            if isinstance(field, MongoDBManyToManyField) and \
+               field.rel.edges is not None and host.pk is not None:
+                manager = getattr(host, name)
+                if not manager.is_loaded():
+                    lazy_managers[ObjectId(host.pk)] = manager
+        if lazy_managers:
+            related_ids = field.rel.edges.related_ids_by_host(lazy_managers)
+            for host_pk, manager in lazy_managers.iteritems():
+                manager.objects = RelatedObjectList(
+                        RelatedEntry(pk, None) for pk in related_ids[host_pk])
+
+    # Group the objects to load by related model, so that fields referring to
+    # the same model share the queries
+    objects_by_model = {}
+    for host in hosts:
+        for name in field_names:
+            field = host._meta.get_field(name)
+            if not isinstance(field, MongoDBManyToManyField):
+                raise ValueError("'%s' is not a MongoDBManyToManyField of %s"
+                                 % (name, host._meta.object_name))
+            manager = getattr(host, name)
+            rel, objects = objects_by_model.setdefault(field.rel.to,
+                                                       (field.rel, []))
+            objects.extend(manager.objects)
+
+    for model, (rel, objects) in objects_by_model.iteritems():
+        load_objects(model, objects, using=using,
+                     chunk_size=chunk_size or rel.chunk_size)
+    return hosts
+
+
+def with_related(hosts, *field_names, **kwargs):
+    """
+    Load host model instances and the related objects of their non-embedded
+    MongoDBManyToManyFields in one server round trip.
+
+    The hosts are fetched with an aggregation on the host collection, where a
+    $lookup stage per field joins the related documents on the stored ids
+    ('<column>.id' -> '_id'). The related managers of every host are filled
+    with the joined instances, in the order of the stored list. Related
+    objects not found in db are left unloaded. Embedded fields need no join
+    and are ignored. The related collections must be in the same database as
+    the host collection.
+
+    Only supported kwargs are 'using' and 'only', a dict of the names of the
+    only fields of the related objects to fetch by field name, projected by
+    the server (the related instances are deferred, as with QuerySet.only).
+
+    Example:
+    >>> articles = with_related(Article, 'categories')
+    >>> articles = with_related(Article.tags.filter(name="men")
+    ...                             .order_by('-date').limit(20),
+    ...                         'categories', only={'categories': ['title']})
+    >>> for article in articles:
+    ...     article.categories.all() # no more queries
+
+    :param hosts: host model, or a MongoDBM2MHostQuerySet (e.g.
+                  Article.categories.all().filter_host(...)) whose query,
+                  ordering and limit are applied
+    :param field_names: names of the MongoDBManyToManyFields to join
+    :returns: list of the host instances
+    """
+    from .fields import MongoDBManyToManyField
+    from .query import MongoDBM2MHostQuerySet
+
+    using = kwargs.pop('using', None)
+    only = kwargs.pop('only', None) or {}
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments to with_related: %s'
+                        % (list(kwargs),))
+    if isinstance(hosts, MongoDBM2MHostQuerySet):
+        model = hosts.model
+        spec, sort, limit = hosts.get_query(), hosts._get_sort(), hosts._limit
+    else:
+        model = hosts
+        spec, sort, limit = {}, [], None
+    using = using or router.db_for_read(model)
+
+    pipeline = []
+    if spec:
+        pipeline.append({'$match': spec})
+    if sort:
+        pipeline.append({'$sort': SON(sort)})
+    if limit is not None:
+        pipeline.append({'$limit': limit})
+
+    # Joined documents are stored under a key per field, removed before
+    # building the host instances
+    joins = []
+    for name in field_names:
+        field = model._meta.get_field(name)
+        if not isinstance(field, MongoDBManyToManyField):
+            raise ValueError("'%s' is not a MongoDBManyToManyField of %s"
+                             % (name, model._meta.object_name))
+        if field.rel.edges is not None:
+            raise ValueError("The relations of '%s.%s' are stored in an edge "
+                             "collection, use prefetch_mongom2m() instead"
+                             % (model._meta.object_name, name))
+        if field.rel.embed:
+            continue
+        related_opts = field.rel.to._meta
+        key = '_mongom2m_%s' % field.column
+        pipeline.append({'$lookup': {
+                'from': related_opts.db_table,
+                'localField': '%s.%s' % (field.column, related_opts.pk.column),
+                'foreignField': '_id',
+                'as': key}})
+        deferred = ()
+        if name in only:
+            only_fields = set(get_field_by_name_or_attname(field.rel.to, f)
+                              for f in only[name])
+            only_fields.add(related_opts.pk)
+            deferred = [f.attname for f in related_opts.fields
+                        if f not in only_fields]
+        joins.append((field, key, deferred))
+    if not joins:
+        if isinstance(hosts, MongoDBM2MHostQuerySet):
+            return list(hosts)
+        return list(model._default_manager.using(using).all())
+
+    if any(deferred for field, key, deferred in joins):
+        # Project the related documents, keeping all the host fields
+        projection = dict(('_id' if f is model._meta.pk else f.column, 1)
+                          for f in model._meta.fields)
+        for field, key, deferred in joins:
+            if deferred:
+                projection.update(('%s.%s' % (key, '_id' if
+                                   f is field.rel.to._meta.pk else f.column), 1)
+                                  for f in field.rel.to._meta.fields
+                                  if f.attname not in deferred)
+            else:
+                projection[key] = 1
+        pipeline.append({'$project': projection})
+
+    collection = connections[using].get_collection(model._meta.db_table)
+    instances = []
+    for document in collection.aggregate(pipeline):
+        related = []
+        for field, key, deferred in joins:
+            related.append(dict(
+                    (related_document['_id'], instance_from_document(
+                        field.rel.to, related_document, using, deferred))
+                    for related_document in document.pop(key, ())))
+        host = instance_from_document(model, document, using)
+        for (field, key, deferred), objs in zip(joins, related):
+            for obj in getattr(host, field.name).objects:
+                if not obj.obj:
+                    obj.obj = objs.get(obj.pk)
+        instances.append(host)
+    return instances
+
+def annotate_m2m_counts(objs, field, attr=None, using=None):
+    """
+    Set on each of the given related model instances the number of host
+    model instances related to it through a MongoDBManyToManyField, counted
+    by the database for all the instances with a single aggregation.
+
+    The hosts referring to the instances are matched on the indexable stored
+    ids, the ids are unwound and grouped by id. With storage='collection',
+    the edges of the instances are grouped by related id.
+
+    Example:
+    >>> categories = annotate_m2m_counts(Category.objects.all()[:50],
+    ...                                  Article.categories)
+    >>> for category in categories:
+    ...     print category.article_set_count
+
+    :param objs: iterable of related model instances, e.g. a QuerySet
+    :param field: the MongoDBManyToManyField, or its descriptor on the host
+                  model (e.g. Article.categories)
+    :param attr: name of the attribute to set the counts to, by default the
+                 related name of the field followed by '_count'
+    :param using: db alias of the host model
+    :returns: list of the related model instances
+    """
+    field = getattr(field, 'field', field)
+    if attr is None:
+        attr = '%s_count' % field.rel.related_name
+    objs = list(objs)
+    ids = list(set(ObjectId(obj.pk) for obj in objs if obj.pk is not None))
+
+    counts = {}
+    if ids:
+        if field.rel.edges is not None:
+            collection = field.rel.edges.get_collection(using)
+            pipeline = [{'$match': {'related_id': {'$in': ids}}},
+                        {'$group': {'_id': '$related_id',
+                                    'count': {'$sum': 1}}}]
+        else:
+            using = using or router.db_for_read(field.model)
+            collection = connections[using].get_collection(
+                                                    field.model._meta.db_table)
+            ids_path = '%s.%s' % (field.column, field.rel.to._meta.pk.column)
+            # The first $match uses the index on the ids, the second one
+            # skips the other related objects of the hosts
+            pipeline = [{'$match': {ids_path: {'$in': ids}}},
+                        {'$project': {ids_path: 1}},
+                        {'$unwind': '$' + field.column},
+                        {'$match': {ids_path: {'$in': ids}}},
+                        {'$group': {'_id': '$' + ids_path,
+                                    'count': {'$sum': 1}}}]
+        counts = dict((result['_id'], result['count'])
+                      for result in collection.aggregate(pipeline))
+
+    for obj in objs:
+        count = 0
+        if obj.pk is not None:
+            count = counts.get(ObjectId(obj.pk), 0)
+        setattr(obj, attr, count)
+    return objs
@@ -1,6 +1,9 @@
 
-from django.db import router
-from .utils import get_exists_ids
+from itertools import islice
+from django.db import models, router, connections
+from django.db.models import Q
+from .objectlist import RelatedEntry, RelatedObjectList
+from .utils import get_exists_ids, load_objects, eval_Q, compile_elem_match
 try:
     # ObjectId has been moved to bson.objectid in newer versions of PyMongo
     from bson.objectid import ObjectId
@@ -18,6 +21,11 @@ class MongoDBM2MQuerySet(object):
     Works similarly to Django's own query set objects.
     Lazily loads non-embedded objects when iterated.
     If embed=False, objects are always loaded from database.
+
+    filter(), exclude() and order_by() are lazy: when evaluated, they compile
+    to one query on the related collection, restricted to the related ids
+    ('_id $in <ids>'). When the objects are embedded, they are evaluated in
+    memory against the embedded copies instead.
     """
     def __init__(self, rel, model, objects,
                  use_cached=True,
@@ -25,7 +33,8 @@ class MongoDBM2MQuerySet(object):
                  **kwargs):
         self.db = router.db_for_read(rel.model if rel.model else rel.field.model)
         self.rel = rel
-        self.objects = list(objects) # make a copy of the list to avoid problems
+        # The model of the objects, the host model for reverse relations
+        self.to = kwargs.get('to') or rel.to
 
         self.model = model
         (self.appear_as_relationship_model, self.rel_model_instance,
@@ -34,58 +43,237 @@ class MongoDBM2MQuerySet(object):
         if self.appear_as_relationship_model:
             self.model = self.appear_as_relationship_model
         self.use_cached = use_cached
-        if not self.use_cached:
-            # Reset any cached instances
-            self.objects = [{'pk': obj['pk'], 'obj': None}
-                            for obj in self.objects]
+        # Pending filter/exclude conditions (Q objects) and ordering
+        self._where = []
+        self._ordering = ()
+        # Deferred loading of the related objects, as only() and defer()
+        self._only = ()
+        self._defer = ()
         #whether clear none exists objs for potential trouble
         self.exists_in_db_only = kwargs.get('exists_in_db_only', False)
-        if self.exists_in_db_only:
+        # With objects=None, the objects are taken from this manager the
+        # first time they're needed, see _get_objects()
+        self._manager = kwargs.get('manager')
+        self._objects = None
+        if objects is not None:
+            self.objects = self._prepare_objects(objects)
+
+    def _prepare_objects(self, objects):
+        # make a (copy-on-write) copy of the list to avoid problems
+        objects = RelatedObjectList(objects)
+        if not self.use_cached:
+            # Reset any cached instances
+            objects = RelatedObjectList(RelatedEntry(obj.pk, None)
+                                        for obj in objects)
+        if self.exists_in_db_only and not self._pulls_on_delete():
             #using only objects stored in db
-            exists_ids = [obj['_id'] for obj in get_exists_ids(self.model, self.rel, self.objects)]
-            self.objects = [obj for obj in self.objects if obj['pk'] in exists_ids]
+            exists_ids = set(obj['_id'] for obj in get_exists_ids(self.model, self.rel, objects))
+            objects = RelatedObjectList(obj for obj in objects
+                                        if obj.pk in exists_ids)
+        return objects
 
+    def _get_objects(self):
+        if self._objects is None:
+            self._objects = self._prepare_objects(self._manager.objects)
+        return self._objects
 
-    def _get_obj(self, obj):
-        if not obj.get('obj'):
-            try:
-                # Load referred instance from db and keep in memory
-                obj['obj'] = self.rel.to.objects.get(pk=obj['pk'])
-            except self.rel.to.DoesNotExist:
-                pass
-                # obj['obj'] will be None
+    def _set_objects(self, objects):
+        self._objects = objects
+
+    objects = property(_get_objects, _set_objects)
+
+    def _is_lazy(self):
+        """
+        Whether the objects of the host document are not loaded, and can be
+        counted or sliced on the server without loading them all.
+        """
+        return (self._objects is None and not self._where and
+                not self._ordering and not self.exists_in_db_only)
+
+    def _pulls_on_delete(self):
+        """
+        Whether ids of deleted objects are removed from the field on delete,
+        so there is no need to check they still exist in db.
+        """
+        from .fields import PULL
+        return self.rel.on_delete is PULL
+
+    def _get_obj(self, obj, load=True):
+        if load and not obj.obj:
+            # Load referred instance from db and keep in memory,
+            # obj.obj will be None if not found
+            self._load_objs([obj])
         if self.appear_as_relationship_model:
             # Wrap us in a relationship class
             if self.rel_model_instance:
                 args = {'pk': "%s$f$%s" %
-                              (self.rel_model_instance.pk, obj['pk']),
+                              (self.rel_model_instance.pk, obj.pk),
                         self.rel_model_name: self.rel_model_instance,
-                        self.rel_to_name: obj['obj']}
+                        self.rel_to_name: obj.obj}
             else:
                 # Reverse
-                args = {'pk': "%s$r$%s" % (self.rel_to_instance.pk, obj['pk']),
-                        self.rel_model_name: obj['obj'],
+                args = {'pk': "%s$r$%s" % (self.rel_to_instance.pk, obj.pk),
+                        self.rel_model_name: obj.obj,
                         self.rel_to_name: self.rel_to_instance}
             wrapper = self.appear_as_relationship_model(**args)
             return wrapper
-        return obj['obj']
+        return obj.obj
+
+    def _load_objs(self, objects):
+        """
+        Load all the given objects not loaded yet with batched $in queries.
+        """
+        load_objects(self.to, objects, using=self.db,
+                     chunk_size=self.rel.chunk_size,
+                     only=self._only, defer=self._defer)
+
+    def _iter_objs(self, objects):
+        """
+        Yield the instances of the given objects in order, loading them from
+        the database chunk by chunk. Objects not found in db are skipped.
+        """
+        chunk_size = self.rel.chunk_size
+        for start in xrange(0, len(objects), chunk_size):
+            chunk = objects[start:start + chunk_size]
+            self._load_objs(chunk)
+            for obj in chunk:
+                #ignore obj of nowhere
+                obj_cached_or_loaded = self._get_obj(obj, load=False)
+                if not obj_cached_or_loaded is None:
+                    yield obj_cached_or_loaded
+
+    def _in_memory(self):
+        """
+        Whether filters are evaluated on the embedded copies rather than
+        by the database.
+        """
+        return self.rel.embed and self.use_cached
+
+    def _filtered_queries(self):
+        """
+        Yield the QuerySets on the related model matching the pending
+        conditions, one per chunk of chunk_size related ids like
+        load_objects(), so that no query holds all the ids.
+        """
+        manager = self.to._default_manager.using(self.db)
+        pks = self.objects.pks()
+        chunk_size = self.rel.chunk_size
+        for start in xrange(0, len(pks), chunk_size):
+            qs = manager.filter(pk__in=pks[start:start + chunk_size])
+            for q in self._where:
+                qs = qs.filter(q)
+            if self._ordering:
+                qs = qs.order_by(*self._ordering)
+            if self._only:
+                qs = qs.only(*self._only)
+            if self._defer:
+                qs = qs.defer(*self._defer)
+            yield qs
+
+    def _sort_objects(self, objects):
+        """
+        Sort the loaded objects in place by the ordering fields.
+        """
+        # Stable sorts from the last ordering field to the first one
+        for name in reversed(self._ordering):
+            reverse = name.startswith('-')
+            name = name.lstrip('-')
+            if name == 'pk':
+                name = self.to._meta.pk.attname
+            objects.sort(key=lambda obj: getattr(obj.obj, name),
+                         reverse=reverse)
+
+    def _evaluate(self):
+        """
+        Apply the pending filter/exclude/order_by to self.objects.
+        """
+        if not self._where and not self._ordering:
+            return
+        if not self.objects:
+            pass
+        elif self._in_memory():
+            self._load_objs(list(self.objects))
+            objects = [obj for obj in self.objects if obj.obj is not None
+                       and all(eval_Q(obj.obj, q) for q in self._where)]
+            self._sort_objects(objects)
+            self.objects = RelatedObjectList(objects)
+        else:
+            found = [RelatedEntry(ObjectId(obj.pk), obj)
+                     for qs in self._filtered_queries() for obj in qs]
+            if self._ordering:
+                # Every chunk is ordered by its query, merge them
+                objects = found
+                if len(self.objects) > self.rel.chunk_size:
+                    self._sort_objects(objects)
+            else:
+                # Keep the order the objects were added in
+                found = dict((obj.pk, obj) for obj in found)
+                objects = [found[pk] for pk in self.objects.pks()
+                           if pk in found]
+            self.objects = RelatedObjectList(objects)
+        self._where = []
+        self._ordering = ()
+
+    def _iter_object_windows(self):
+        """
+        Yield the objects of a lazy query set, loaded from the manager one
+        window of chunk_size objects at a time.
+        """
+        for objects in self._manager._iter_windows(self.rel.chunk_size):
+            yield self._prepare_objects(objects)
+
+    def _iter_windows(self):
+        """
+        Yield the instances of a lazy query set, see _iter_object_windows().
+        """
+        for objects in self._iter_object_windows():
+            for obj in self._iter_objs(objects):
+                yield obj
 
     def __iter__(self):
-        for obj in list(self.objects):
-            #ignore obj of nowhere
-            obj_cached_or_loaded = self._get_obj(obj)
-            if not obj_cached_or_loaded is None:
-                yield obj_cached_or_loaded
+        if self._is_lazy():
+            return self._iter_windows()
+        self._evaluate()
+        return self._iter_objs(list(self.objects))
 
     def __repr__(self):
         from . import REPR_OUTPUT_SIZE
-        # limit list after conversion because mongodb doesn't use integer indices
-        data = list(self)[:REPR_OUTPUT_SIZE + 1]
+        if self._is_lazy():
+            data = self[:REPR_OUTPUT_SIZE + 1]
+        else:
+            # limit list after conversion because mongodb doesn't use integer indices
+            data = list(islice(self, REPR_OUTPUT_SIZE + 1))
         if len(data) > REPR_OUTPUT_SIZE:
            data[-1] = "...(remaining elements truncated)..."
         return repr(data)
 
+    def _load_window(self, offset, limit):
+        """
+        Return the objects of a window of the host's list, fetched with a
+        $slice projection without loading the whole list.
+        """
+        return self._prepare_objects(
+                        self._manager._load_window(offset, limit))
+
     def __getitem__(self, key):
+        if self._is_lazy():
+            if isinstance(key, slice):
+                if key.step is None and (key.start or 0) >= 0 and \
+                   (key.stop is None or key.stop >= 0):
+                    start = key.start or 0
+                    limit = None
+                    if key.stop is not None:
+                        limit = max(key.stop - start, 0)
+                    return list(self._iter_objs(
+                                        self._load_window(start, limit)))
+            elif key >= 0:
+                objects = self._load_window(key, 1)
+                if not objects:
+                    raise IndexError('list index out of range')
+                return self._get_obj(objects[0])
+        self._evaluate()
+        if isinstance(key, slice):
+            return list(self._iter_objs(self.objects[key]))
         obj = self.objects[key]
         return self._get_obj(obj)
 
@@ -93,25 +281,106 @@ class MongoDBM2MQuerySet(object):
         return self
 
     def __len__(self):
+        if self._is_lazy():
+            return self._manager.count()
+        self._evaluate()
         return len(self.objects)
 
     def using(self, db, *args, **kwargs):
         self.db = db
         return self
 
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        if self.appear_as_relationship_model:
+            # Lookups are on the intermediate model, used by the admin
+            return self
+        if not args and not kwargs:
+            return self._clone()
+        q = Q(*args, **kwargs)
+        clone = self._clone()
+        clone._where.append(~q if negate else q)
+        return clone
+
     def filter(self, *args, **kwargs):
-        return self
+        return self._filter_or_exclude(False, *args, **kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._filter_or_exclude(True, *args, **kwargs)
+
+    def order_by(self, *field_names):
+        if self.appear_as_relationship_model:
+            return self
+        clone = self._clone()
+        clone._ordering = field_names
+        return clone
+
+    def _deferred_clone(self):
+        clone = self._clone()
+        if not self._in_memory() and self._objects is not None:
+            # Don't share the deferred instances with the cache of the manager
+            clone.objects = RelatedObjectList(RelatedEntry(obj.pk, None)
+                                              for obj in self.objects)
+        return clone
+
+    def only(self, *fields):
+        """
+        Only load the given fields of the related objects from db, embedded
+        objects are already in memory and are returned whole.
+        """
+        clone = self._deferred_clone()
+        clone._only = fields
+        return clone
+
+    def defer(self, *fields):
+        """
+        Don't load the given fields of the related objects from db, embedded
+        objects are already in memory and are returned whole.
+        """
+        clone = self._deferred_clone()
+        if fields == (None,):
+            clone._defer = ()
+        else:
+            clone._defer = self._defer + fields
+        return clone
 
     def get(self, *args, **kwargs):
-        if 'pk' in kwargs:
-            pk = ObjectId(kwargs['pk'])
-            for obj in self.objects:
-                if pk == obj['pk']:
-                    return self._get_obj(obj)
-        return None
+        if args or list(kwargs) != ['pk']:
+            if args or kwargs:
+                objects = list(self.filter(*args, **kwargs))
+            else:
+                objects = list(self)
+            if len(objects) == 1:
+                return objects[0]
+            if not objects:
+                raise self.to.DoesNotExist(
+                    "%s matching query does not exist."
+                    % self.to._meta.object_name)
+            raise self.to.MultipleObjectsReturned(
+                "get() returned more than one %s -- it returned %s!"
+                % (self.to._meta.object_name, len(objects)))
+        if self._is_lazy():
+            obj = self._manager._get_entry(ObjectId(kwargs['pk']))
+        else:
+            self._evaluate()
+            obj = self.objects.get(ObjectId(kwargs['pk']))
+        if obj is not None:
+            instance = self._get_obj(obj)
+            if instance is not None:
+                return instance
+        # self.model is the intermediate model of relationship query sets
+        raise self.model.DoesNotExist(
+            "%s matching query does not exist."
+            % self.model._meta.object_name)
 
     def count(self):
-        return len(self.objects)
+        if self._where and not self._in_memory():
+            return sum(qs.count() for qs in self._filtered_queries())
+        return len(self)
+
+    def exists(self):
+        if self._where and not self._in_memory():
+            return any(qs.exists() for qs in self._filtered_queries())
+        return len(self) > 0
 
     def _clone(self, klass=None, setup=False, **kwargs):
         '''
@@ -120,25 +389,128 @@ class MongoDBM2MQuerySet(object):
         '''
         if klass is None:
             klass = self.__class__
-        #copy self.objects
-        objects = list(self.objects)
-        c = klass(rel=self.rel, model=self.model, objects=objects,
-                  use_cached=self.use_cached,
+        #self.objects is copied by the new query set
+        c = klass(rel=self.rel, model=self.model, objects=self._objects,
+                  use_cached=self.use_cached, manager=self._manager,
+                  to=self.to,
                   appear_as_relationship=(
                       self.appear_as_relationship_model,
                       self.rel_model_instance,
                       self.rel_to_instance,
                       self.rel_model_name, self.rel_to_name),
               )
+        c._where = list(self._where)
+        c._ordering = self._ordering
+        c._only = self._only
+        c._defer = self._defer
         c.__dict__.update(kwargs)
         #no use for now
         if setup and hasattr(c, '_setup_query'):
             c._setup_query()
         return c
 
+    def _has_values(self, obj, columns):
+        '''
+        whether the values of the given columns can be read from the cached
+        or embedded copy of obj, without a query
+        '''
+        raw = getattr(obj, 'raw', None)
+        if isinstance(raw, dict):
+            return all(column in raw for column in columns)
+        return (self.use_cached and obj.obj is not None and
+                not getattr(obj.obj, '_deferred', False))
+
+    def _iter_values(self, fields):
+        '''
+        yield the values of the given fields for every related object, as
+        lists in the order of fields. pks are known without any query, the
+        other fields are read from the embedded or cached copies when they
+        contain them, or else loaded with projected $in queries
+        '''
+        opts = self.to._meta
+        pk_names = ('pk', opts.pk.name, opts.pk.attname)
+        attnames = {}
+        for name in fields:
+            if name in pk_names:
+                continue
+            try:
+                field = opts.get_field(name)
+            except models.FieldDoesNotExist:
+                # Not a field, read the attribute of whole objects
+                attnames = None
+                break
+            attnames[name] = (field.attname, field.column)
+
+        columns = [column for attname, column in (attnames or {}).values()]
+        manager = self.to._default_manager.using(self.db)
+        query_fields = ['pk'] + sorted(set(attname for attname, column
+                                           in (attnames or {}).values()))
+        for objects in self._iter_value_windows():
+            if attnames is None:
+                for instance in self._iter_objs(objects):
+                    yield [getattr(instance, name, None) for name in fields]
+                continue
+
+            values = {}
+            missing = [obj.pk for obj in objects
+                       if attnames and not self._has_values(obj, columns)]
+            if missing:
+                for row in manager.filter(pk__in=missing).values(*query_fields):
+                    values[ObjectId(row['pk'])] = row
+
+            for obj in objects:
+                row = values.get(obj.pk)
+                if attnames and row is None:
+                    if not self._has_values(obj, columns):
+                        # Not found in db
+                        continue
+                    instance = obj.obj
+                    row = dict((attname, getattr(instance, attname))
+                               for attname, column in attnames.values())
+                yield [unicode(obj.pk) if name in pk_names
+                       else row[attnames[name][0]] for name in fields]
+
+    def _iter_value_windows(self):
+        '''
+        yield the objects to read values from, in lists of up to chunk_size
+        objects. The objects of lazy sources (e.g. reverse relations) are
+        loaded window by window, instead of all at once
+        '''
+        if self._objects is None and not self._where and not self._ordering:
+            # Objects missing from db are filtered out per window by
+            # _prepare_objects() with exists_in_db_only
+            for objects in self._iter_object_windows():
+                yield list(objects)
+            return
+        self._evaluate()
+        objects = list(self.objects)
+        if self.exists_in_db_only and not self._pulls_on_delete() and objects:
+            exists_ids = set(obj['_id'] for obj in
+                             get_exists_ids(self.model, self.rel, objects))
+            objects = [obj for obj in objects if obj.pk in exists_ids]
+        chunk_size = self.rel.chunk_size
+        for start in xrange(0, len(objects), chunk_size):
+            yield objects[start:start + chunk_size]
+
+    def _default_fields(self):
+        return [field.attname for field in self.to._meta.fields]
+
+    def values(self, *fields, **kwargs):
+        '''
+        Emulate QuerySet.values, loading only the requested fields
+        '''
+        exists_in_db_only = kwargs.pop('exists_in_db_only', self.exists_in_db_only)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values: %s'
+                    % (list(kwargs),))
+        return self._clone(klass=MongoDBM2MValuesQuerySet, setup=True,
+                           exists_in_db_only=exists_in_db_only,
+                           _fields=fields or self._default_fields())
+
     def values_list(self, *fields, **kwargs):
         '''
-        Emulate QuerySet.values_list required by django.contrib.admin
+        Emulate QuerySet.values_list required by django.contrib.admin,
+        values_list('pk', flat=True) doesn't need any query
         '''
         flat = kwargs.pop('flat', False)
         #required True for django.contrib.admin
@@ -151,7 +523,7 @@ class MongoDBM2MQuerySet(object):
         return self._clone(klass=MongoDBM2MValuesListQuerySet, setup=True,
                            flat=flat,
                            exists_in_db_only=exists_in_db_only,
-                           _fields=fields)
+                           _fields=fields or self._default_fields())
 
 class MongoDBM2MValuesListQuerySet(MongoDBM2MQuerySet):
     '''
@@ -161,27 +533,13 @@ class MongoDBM2MValuesListQuerySet(MongoDBM2MQuerySet):
         '''
         iterator yield only fields requested
         '''
-        for obj in list(self.objects):
-            obj_cached_or_loaded = self._get_obj(obj)
-            # skip when obj not in cached and db
-            if obj_cached_or_loaded is None:
-                pass
-            else:
-                #behavior same as ValuesListQuerySet.iterator
-                if self.flat and len(self._fields) == 1:
-                    field = self._fields[0]
-                    if hasattr(obj['obj'], field):
-                        yield obj['obj'].__getattribute__(field)
-                    else:
-                        yield None
-                else:
-                    row = list()
-                    for field in self._fields:
-                        if hasattr(obj['obj'], field):
-                            row.append(obj['obj'].__getattribute__(field))
-                        else:
-                            row.append(None)
-                    yield tuple(row)
+        #behavior same as ValuesListQuerySet.iterator
+        if self.flat and len(self._fields) == 1:
+            for row in self._iter_values(self._fields):
+                yield row[0]
+        else:
+            for row in self._iter_values(self._fields):
+                yield tuple(row)
 
     def __iter__(self):
         for item in self.iterator():
@@ -195,4 +553,396 @@ class MongoDBM2MValuesListQuerySet(MongoDBM2MQuerySet):
         if not hasattr(clone, "flat"):
             # Only assign flat if the clone didn't already get it from kwargs
             clone.flat = self.flat
+        if not hasattr(clone, "_fields"):
+            clone._fields = self._fields
+            clone.exists_in_db_only = self.exists_in_db_only
+        return clone
+
+
+class MongoDBM2MValuesQuerySet(MongoDBM2MQuerySet):
+    '''
+    simulate ValuesQuerySet, using objects instead of query
+    '''
+    def iterator(self):
+        '''
+        iterator yield dicts of the fields requested
+        '''
+        for row in self._iter_values(self._fields):
+            yield dict(zip(self._fields, row))
+
+    def __iter__(self):
+        for item in self.iterator():
+            yield item
+
+    def _clone(self, *args, **kwargs):
+        '''
+        override MongoDBM2MQuerySet._clone, clone this query set
+        '''
+        clone = super(MongoDBM2MValuesQuerySet, self)._clone(*args, **kwargs)
+        if not hasattr(clone, "_fields"):
+            clone._fields = self._fields
+            clone.exists_in_db_only = self.exists_in_db_only
+        return clone
+
+
+class MongoDBM2MHostQuerySet(object):
+    """
+    Lazy query set of host model instances, returned by the queries of the
+    descriptor of a MongoDBManyToManyField, e.g. Article.categories.filter().
+
+    filter() and exclude() stay aware of the field when chained, conditions
+    on the fields of the host model itself are added with filter_host() and
+    exclude_host(). All the conditions, the ordering and the limit are
+    compiled into a single MongoDB query, run as a raw_query of the host
+    model when the query set is evaluated. Other QuerySet methods are
+    delegated to that query set.
+
+    Example:
+    >>> Article.categories.filter(title="shirts").exclude(title="men") \\
+    ...     .filter_host(published=True).order_by('-date').limit(10)
+    """
+    def __init__(self, field):
+        self.field = field
+        self.model = field.model
+        self._conditions = []
+        self._ordering = ()
+        self._limit = None
+        # The host QuerySet, once evaluated
+        self._result = None
+
+    def _clone(self):
+        clone = self.__class__(self.field)
+        clone._conditions = list(self._conditions)
+        clone._ordering = self._ordering
+        clone._limit = self._limit
         return clone
+
+    def _add_condition(self, condition):
+        clone = self._clone()
+        if condition:
+            clone._conditions.append(condition)
+        return clone
+
+    def _get_connection(self):
+        return connections[router.db_for_read(self.model)]
+
+    def _raise_query_error(self, args, kwargs):
+        raise MongoDBM2MQueryError(
+            "Invalid query paramaters: '%s; %s'. M2M Fields not using the "
+            "'embed=True' option can only filter on 'pk' because only "
+            "the related model's pk is stored for non-embedded M2Ms. "
+            "Note: M2M fields that are converted to 'embed=True' do "
+            "not convert the stored values automatically. Every "
+            "instance of the host-model must be re-saved after "
+            "converting the field." % (args, kwargs))
+
+    def _related_ids(self, objs):
+        """
+        Return the ObjectIds of model instances, ObjectIds or id strings.
+        """
+        return [ObjectId(obj) if isinstance(obj, (ObjectId, basestring))
+                else ObjectId(obj.pk) for obj in objs]
+
+    def _hosts_condition(self, host_ids, negate=False):
+        return {'_id': {'$nin' if negate else '$in': list(host_ids)}}
+
+    def _m2m_condition(self, negate, args, kwargs):
+        """
+        Compile conditions on the related objects, see
+        MongoDBManyToManyRelationDescriptor._filter_or_exclude().
+        """
+        elem_match = kwargs.pop('elem_match', False)
+        if not args and not kwargs:
+            return None
+        rel = self.field.rel
+        related_model = rel.to
+        column = self.field.column
+
+        if rel.edges is not None:
+            # Relations are stored in the edge collection, the hosts are
+            # found with the reverse index of the edges
+            if elem_match or args or set(kwargs) - set(['pk', 'pk__in']):
+                self._raise_query_error(args, kwargs)
+            pks = list(kwargs.get('pk__in', ()))
+            if 'pk' in kwargs:
+                pks.append(kwargs['pk'])
+            return self._hosts_condition(
+                    rel.edges.host_ids(self._related_ids(pks)), negate)
+
+        allowed_fields = None
+        if not rel.embed:
+            allowed_fields = ['pk', related_model._meta.pk.name]
+        q = Q(*args, **kwargs)
+        connection = self._get_connection()
+        try:
+            if elem_match:
+                condition = compile_elem_match(q, related_model, connection,
+                                               allowed_fields)
+            else:
+                condition = compile_elem_match(q, related_model, connection,
+                                               allowed_fields, prefix=column)
+        except MongoDBM2MQueryError:
+            if allowed_fields:
+                self._raise_query_error(args, kwargs)
+            raise
+        if not condition:
+            # No conditions, e.g. filter(Q())
+            return None
+        if elem_match:
+            if negate:
+                return {column: {'$not': {'$elemMatch': condition}}}
+            return {column: {'$elemMatch': condition}}
+        return {'$nor': [condition]} if negate else condition
+
+    def filter(self, *args, **kwargs):
+        """
+        Filter by conditions on the related objects.
+        See MongoDBManyToManyRelationDescriptor._filter_or_exclude().
+        """
+        return self._add_condition(self._m2m_condition(False, args, kwargs))
+
+    def exclude(self, *args, **kwargs):
+        """
+        Exclude by conditions on the related objects.
+        See MongoDBManyToManyRelationDescriptor._filter_or_exclude().
+        """
+        return self._add_condition(self._m2m_condition(True, args, kwargs))
+
+    def _host_condition(self, negate, args, kwargs):
+        if not args and not kwargs:
+            return None
+        condition = compile_elem_match(Q(*args, **kwargs), self.model,
+                                       self._get_connection(),
+                                       pk_column='_id')
+        if not condition:
+            return None
+        return {'$nor': [condition]} if negate else condition
+
+    def filter_host(self, *args, **kwargs):
+        """
+        Filter by conditions on the fields of the host model, supporting the
+        lookup types of compile_elem_match().
+        """
+        return self._add_condition(self._host_condition(False, args, kwargs))
+
+    def exclude_host(self, *args, **kwargs):
+        """
+        Exclude by conditions on the fields of the host model, supporting the
+        lookup types of compile_elem_match().
+        """
+        return self._add_condition(self._host_condition(True, args, kwargs))
+
+    def _ids_path(self):
+        return '%s.%s' % (self.field.column, self.field.rel.to._meta.pk.column)
+
+    def _check_inline(self, method):
+        """
+        Raise MongoDBM2MQueryError for queries which need the ids stored in
+        the host documents, not available with storage='collection'.
+        """
+        if self.field.rel.edges is not None:
+            raise MongoDBM2MQueryError(
+                "%s() is not supported on '%s.%s': its relations are stored "
+                "in an edge collection. Query the reverse manager of the "
+                "related objects instead."
+                % (method, self.model._meta.object_name, self.field.name))
+
+    def filter_all(self, objs):
+        """
+        Filter the hosts related to all the given objects (model instances or
+        ids), with $all.
+        """
+        self._check_inline('filter_all')
+        ids = self._related_ids(objs)
+        return self._add_condition({self._ids_path(): {'$all': ids}})
+
+    def filter_any(self, objs):
+        """
+        Filter the hosts related to any of the given objects (model instances
+        or ids), with $in.
+        """
+        self._check_inline('filter_any')
+        ids = self._related_ids(objs)
+        return self._add_condition({self._ids_path(): {'$in': ids}})
+
+    def filter_none(self, objs):
+        """
+        Filter the hosts related to none of the given objects (model
+        instances or ids), with $nin.
+        """
+        self._check_inline('filter_none')
+        ids = self._related_ids(objs)
+        return self._add_condition({self._ids_path(): {'$nin': ids}})
+
+    def filter_size(self, size=None, gt=None, gte=None, lt=None, lte=None):
+        """
+        Filter the hosts by number of related objects.
+
+        An exact size matches with $size (or the absence of a first element
+        for size 0, so that hosts without the field match too). Ranges match
+        with the existence of the element at the index of the bound. Neither
+        can use an index, combine them with indexed conditions on large
+        collections.
+        """
+        self._check_inline('filter_size')
+        # Convert the bounds to a number of elements >= low and < high
+        low, high = 0, None
+        if gt is not None:
+            low = max(low, gt + 1)
+        if gte is not None:
+            low = max(low, gte)
+        if lt is not None:
+            high = lt if high is None else min(high, lt)
+        if lte is not None:
+            high = lte + 1 if high is None else min(high, lte + 1)
+        if size is not None:
+            low = max(low, size)
+            high = size + 1 if high is None else min(high, size + 1)
+
+        if high is not None and high <= low:
+            # Nothing can match
+            return self.none()
+        column = self.field.column
+        if size is not None and size > 0 and low == size and \
+           high == size + 1:
+            return self._add_condition({column: {'$size': size}})
+        conditions = []
+        if low > 0:
+            conditions.append({'%s.%d' % (column, low - 1):
+                               {'$exists': True}})
+        if high is not None:
+            conditions.append({'%s.%d' % (column, high - 1):
+                               {'$exists': False}})
+        if len(conditions) > 1:
+            return self._add_condition({'$and': conditions})
+        return self._add_condition(conditions and conditions[0])
+
+    def all(self):
+        return self._clone()
+
+    def none(self):
+        return self._add_condition(self._hosts_condition(()))
+
+    def order_by(self, *field_names):
+        """
+        Order by fields of the host model, like QuerySet.order_by().
+        """
+        clone = self._clone()
+        clone._ordering = field_names
+        return clone
+
+    def limit(self, limit):
+        """
+        Return at most limit host model instances.
+        """
+        clone = self._clone()
+        clone._limit = limit
+        return clone
+
+    def get_query(self):
+        """
+        Return the MongoDB query on the host collection.
+        """
+        if not self._conditions:
+            return {}
+        if len(self._conditions) == 1:
+            return self._conditions[0]
+        return {'$and': self._conditions}
+
+    def _get_sort(self):
+        """
+        Return the ordering as a pymongo sort specification.
+        """
+        opts = self.model._meta
+        sort = []
+        for name in self._ordering:
+            direction = -1 if name.startswith('-') else 1
+            name = name.lstrip('-')
+            if name in ('pk', opts.pk.name):
+                column = '_id'
+            else:
+                column = opts.get_field(name).column
+            sort.append((column, direction))
+        return sort
+
+    def explain(self):
+        """
+        Return MongoDB's explanation of the query, e.g. to check the indexes
+        used.
+        """
+        collection = self._get_connection().get_collection(
+                                                    self.model._meta.db_table)
+        cursor = collection.find(self.get_query())
+        if self._ordering:
+            cursor = cursor.sort(self._get_sort())
+        if self._limit is not None:
+            cursor = cursor.limit(self._limit)
+        return cursor.explain()
+
+    def with_related(self, *field_names, **kwargs):
+        """
+        Return the list of the host model instances, with the related objects
+        of the given fields joined by the server. See
+        prefetch.with_related().
+        """
+        from .prefetch import with_related
+        return with_related(self, *field_names, **kwargs)
+
+    def _get_queryset(self):
+        """
+        Return the host QuerySet running the query.
+        """
+        if self._result is None:
+            queryset = self.model._default_manager.raw_query(self.get_query())
+            if self._ordering:
+                queryset = queryset.order_by(*self._ordering)
+            if self._limit is not None:
+                queryset = queryset[:self._limit]
+            self._result = queryset
+        return self._result
+
+    def get(self, *args, **kwargs):
+        """
+        Return a single host model instance matching the conditions on the
+        related objects, see filter().
+        """
+        results = self.filter(*args, **kwargs)
+        num = len(results)
+        if num == 1:
+            return results[0]
+        elif num < 1:
+            raise self.model.DoesNotExist(
+                            "%s matching query does not exist."
+                            % self.model._meta.object_name)
+        else:
+            raise self.model.MultipleObjectsReturned(
+                        "get() returned more than one %s -- it returned %s! "
+                        "Lookup parameters were %s"
+                        % (self.model._meta.object_name, num, kwargs))
+
+    def __iter__(self):
+        return iter(self._get_queryset())
+
+    def __len__(self):
+        return len(self._get_queryset())
+
+    def __nonzero__(self):
+        return bool(self._get_queryset())
+
+    def __getitem__(self, key):
+        return self._get_queryset()[key]
+
+    def __repr__(self):
+        return repr(self._get_queryset())
+
+    def count(self):
+        return self._get_queryset().count()
+
+    def exists(self):
+        return self._get_queryset().exists()
+
+    def __getattr__(self, name):
+        # Delegate the other QuerySet methods (values_list, update...)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get_queryset(), name)
@@ -1,3 +1,6 @@
+import re
+import warnings
+
 from django.db import models, router, connections
 from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
@@ -140,9 +143,149 @@ def create_through(field, model, to):
     return Through
 
 
+# Django lookup types compiled to a MongoDB operator on the value
+ELEM_MATCH_OPERATORS = {
+    'gt': '$gt',
+    'gte': '$gte',
+    'lt': '$lt',
+    'lte': '$lte',
+    'ne': '$ne',
+}
+
+# Django lookup types compiled to a regular expression, as format strings.
+# '$' alone would also match before a trailing newline.
+ELEM_MATCH_REGEXES = {
+    'iexact': ('^%s(?!\\n)$', 'i'),
+    'contains': ('%s', ''),
+    'icontains': ('%s', 'i'),
+    'startswith': ('^%s', ''),
+    'istartswith': ('^%s', 'i'),
+    'endswith': ('%s(?!\\n)$', ''),
+    'iendswith': ('%s(?!\\n)$', 'i'),
+}
+
+ELEM_MATCH_LOOKUPS = set(['exact', 'in', 'range', 'exists', 'isnull']) | \
+                     set(ELEM_MATCH_OPERATORS) | set(ELEM_MATCH_REGEXES)
+
+def compile_elem_match(q, model, connection, allowed_fields=None,
+                       prefix=None, pk_column=None):
+    """Compile a Q object on the fields of model into the condition of an
+    $elemMatch, so that all the conditions apply to the same element of a
+    list of embedded models.
+
+    Lookups can use the double-underscore lookup types in
+    ELEM_MATCH_LOOKUPS, e.g. Q(title__icontains="men") compiles to
+    {"title": {"$regex": "men", "$options": "i"}}. Values can be A()
+    objects to query the fields of embedded models.
+
+    :param q: The Q object to compile
+    :param model: The model of the embedded instances
+    :param connection: The connection used to convert the values
+    :param allowed_fields: If defined, only fields names listed in
+            'allowed_fields' are allowed.
+            E.g. allowed_fields=["pk"]: Q(pk=1) is good, Q(name="tom") fails.
+    :param prefix: If defined, the column the fields are nested in. E.g.
+            with prefix="categories", Q(title="men") compiles to
+            {"categories.title": "men"}, a condition on the documents of the
+            host model instead of an $elemMatch condition.
+    :param pk_column: The column of the pk, if not the pk field's column
+            (e.g. "_id" for the documents of the model itself)
+    :returns: The condition as a dict, empty if q has no conditions
+    """
+    conditions = []
+    for child in q.children:
+        if isinstance(child, Q):
+            condition = compile_elem_match(child, model, connection,
+                                           allowed_fields, prefix, pk_column)
+            if condition:
+                conditions.append(condition)
+        elif isinstance(child, tuple):
+            conditions.append(compile_elem_lookup(child[0], child[1], model,
+                                                  connection, allowed_fields,
+                                                  prefix, pk_column))
+        else:
+            raise TypeError("Unknown type in Q.children")
+    if not conditions:
+        # MongoDB rejects empty $and/$or
+        return {}
+    if q.connector == Q.OR:
+        condition = {'$or': conditions}
+    elif len(conditions) == 1:
+        condition = conditions[0]
+    else:
+        condition = {'$and': conditions}
+    if q.negated:
+        condition = {'$nor': [condition]}
+    return condition
+
+def compile_elem_lookup(lookup, value, model, connection, allowed_fields=None,
+                        prefix=None, pk_column=None):
+    """Compile a single lookup, e.g. ('title__startswith', 'a'), on the
+    fields of model into a MongoDB condition. See compile_elem_match().
+    """
+    from .query import MongoDBM2MQueryError
+    parts = lookup.split('__')
+    lookup_type = 'exact'
+    if len(parts) > 1 and parts[-1] in ELEM_MATCH_LOOKUPS:
+        lookup_type = parts.pop()
+    if len(parts) != 1 or (allowed_fields and parts[0] not in allowed_fields):
+        raise MongoDBM2MQueryError("Unsupported lookup '%s' on %s"
+                                   % (lookup, model._meta.object_name))
+    try:
+        field = get_field_by_name_or_attname(model, parts[0])
+    except models.FieldDoesNotExist:
+        raise MongoDBM2MQueryError("Cannot resolve keyword '%s' into field "
+                                   "of %s" % (parts[0], model._meta.object_name))
+
+    column = field.column
+    if field is model._meta.pk and pk_column:
+        column = pk_column
+    if prefix:
+        column = '%s.%s' % (prefix, column)
+    if isinstance(value, A):
+        # A query on a field of an embedded model, the value is not converted
+        return {'%s.%s' % (column, value.op): value.val}
+
+    def convert(value):
+        if isinstance(value, models.Model):
+            value = value.pk
+        if value is None:
+            return None
+        if field is model._meta.pk:
+            # The pk is always stored as an ObjectId
+            return ObjectId(value)
+        return connection.ops.value_for_db(
+                    field.get_db_prep_save(value, connection=connection), field)
+
+    if lookup_type == 'exact':
+        condition = convert(value)
+    elif lookup_type == 'in':
+        condition = {'$in': [convert(item) for item in value]}
+    elif lookup_type == 'range':
+        condition = {'$gte': convert(value[0]), '$lte': convert(value[1])}
+    elif lookup_type == 'exists':
+        condition = {'$exists': bool(value)}
+    elif lookup_type == 'isnull':
+        condition = None if value else {'$ne': None}
+    elif lookup_type in ELEM_MATCH_OPERATORS:
+        condition = {ELEM_MATCH_OPERATORS[lookup_type]: convert(value)}
+    else:
+        if value is None:
+            raise ValueError("Cannot use None as the value of lookup '%s'"
+                             % lookup)
+        regex, options = ELEM_MATCH_REGEXES[lookup_type]
+        # Like Django, text lookups match the value as a string
+        condition = {'$regex': regex % re.escape(unicode(value))}
+        if options:
+            condition['$options'] = options
+    return {column: condition}
+
 def replace_Q(q, column, allowed_fields=None):
     """Replace the fields in the Q object with A() objects from 'column'
 
+    Deprecated: the descriptor queries are compiled by compile_elem_match(),
+    e.g. compile_elem_match(q, model, connection, prefix=column).
+
     :param q: The Q object to work on
     :param column: The name of the column the A() objects should be attached to.
     :param allowed_fields: If defined, only fields names listed in
@@ -157,6 +300,8 @@ def replace_Q(q, column, allowed_fields=None):
 
     That would generate the query: {"users.name":"Tom"}
     """
+    warnings.warn('replace_Q is deprecated by compile_elem_match',
+                  DeprecationWarning)
     if not isinstance(q, Q):
         raise ValueError("'q' must be of type Q, not: '%s'" % type(q))
 
@@ -185,6 +330,11 @@ def replace_Q(q, column, allowed_fields=None):
 
 
 def combine_A(field, value):
+    """
+    Deprecated with replace_Q, see compile_elem_lookup.
+    """
+    warnings.warn('combine_A is deprecated by compile_elem_lookup',
+                  DeprecationWarning)
     # The pk is actually stored as "id", so change it, we also need extract the
     # pk from and models and wrap any IDs in an ObjectId,
     if field in ('pk', 'id'):
@@ -214,5 +364,175 @@ def get_exists_ids(model, rel, objects):
     '''
     db = connections[router.db_for_write(model)]
     conn = db.get_collection(rel.to._meta.db_table)
-    ids = [obj['pk'] for obj in objects]
+    ids = [obj.pk for obj in objects]
     return conn.find({"_id":{"$in":ids}},{"_id":1}).limit(len(objects))
+
+def get_field_by_name_or_attname(model, name):
+    '''
+    return the field of model named name, 'pk' or the attname of a field
+    (e.g. 'category_id' for a ForeignKey)
+    '''
+    opts = model._meta
+    if name == 'pk':
+        return opts.pk
+    for field in opts.fields:
+        if name in (field.name, field.attname):
+            return field
+    raise models.FieldDoesNotExist("%s has no field named '%s'"
+                                   % (opts.object_name, name))
+
+def instance_from_document(model, document, using, deferred=()):
+    '''
+    return a model instance built from a raw MongoDB document, converting the
+    values the way django-mongodb-engine does when loading model instances
+
+    :param model: model of the document
+    :param document: dict fetched from the model's collection
+    :param using: db alias the document was fetched from
+    :param deferred: attnames of the fields not fetched, the instance is
+                     created from a deferred class as with QuerySet.defer()
+    '''
+    from django.db.models.query_utils import deferred_class_factory
+    connection = connections[using]
+    opts = model._meta
+    values = {}
+    for field in opts.fields:
+        if field.attname in deferred:
+            continue
+        column = '_id' if field is opts.pk else field.column
+        if column in document:
+            values[field.attname] = connection.ops.value_from_db(
+                                                    document[column], field)
+        else:
+            values[field.attname] = field.get_default()
+    if deferred:
+        model = deferred_class_factory(model, deferred)
+    instance = model(**values)
+    instance._state.db = using
+    instance._state.adding = False
+    return instance
+
+def fetch_objects(model, ids, using=None, chunk_size=None, only=None,
+                  defer=None):
+    '''
+    return a dict of the instances of model with the given ids, keyed by
+    ObjectId, loaded with as few $in queries as possible. ids not found in db
+    are missing from the dict
+
+    :param model: model to load instances of
+    :param ids: ObjectIds to load
+    :param using: db alias to load from
+    :param chunk_size: max number of ids per query
+    :param only: names of the only fields to load, as QuerySet.only
+    :param defer: names of the fields not to load, as QuerySet.defer
+    '''
+    if chunk_size is None:
+        from . import LOAD_CHUNK_SIZE
+        chunk_size = LOAD_CHUNK_SIZE
+    queryset = model._default_manager.all()
+    if using:
+        queryset = queryset.using(using)
+    if only:
+        queryset = queryset.only(*only)
+    if defer:
+        queryset = queryset.defer(*defer)
+    ids = list(ids)
+    instances = {}
+    for start in xrange(0, len(ids), chunk_size):
+        for instance in queryset.filter(pk__in=ids[start:start + chunk_size]):
+            instances[ObjectId(instance.pk)] = instance
+    return instances
+
+def load_objects(model, objects, using=None, chunk_size=None, **kwargs):
+    '''
+    load instances for all objects not loaded yet, with as few $in queries
+    as possible, objects not found in db are left untouched (obj is None)
+
+    :param model: related model to load instances of
+    :param objects: list of internal objects (RelatedEntry)
+    :param using: db alias to load from
+    :param chunk_size: max number of ids per query
+    :param kwargs: 'only' and 'defer' passed to fetch_objects
+    '''
+    missing = {}
+    for obj in objects:
+        if not obj.obj:
+            missing.setdefault(obj.pk, []).append(obj)
+    if not missing:
+        return
+    instances = fetch_objects(model, missing, using=using,
+                              chunk_size=chunk_size, **kwargs)
+    for pk, instance in instances.iteritems():
+        for obj in missing[pk]:
+            obj.obj = instance
+
+# Django lookup types which can be evaluated in Python on model instances
+PYTHON_LOOKUPS = {
+    'exact': lambda a, b: a == b,
+    'iexact': lambda a, b: a is not None and b is not None and
+                           a.lower() == b.lower(),
+    'contains': lambda a, b: a is not None and b in a,
+    'icontains': lambda a, b: a is not None and b.lower() in a.lower(),
+    'startswith': lambda a, b: a is not None and a.startswith(b),
+    'istartswith': lambda a, b: a is not None and
+                                a.lower().startswith(b.lower()),
+    'endswith': lambda a, b: a is not None and a.endswith(b),
+    'iendswith': lambda a, b: a is not None and a.lower().endswith(b.lower()),
+    'in': lambda a, b: a in b,
+    'gt': lambda a, b: a is not None and a > b,
+    'gte': lambda a, b: a is not None and a >= b,
+    'lt': lambda a, b: a is not None and a < b,
+    'lte': lambda a, b: a is not None and a <= b,
+    'range': lambda a, b: a is not None and b[0] <= a <= b[1],
+    'isnull': lambda a, b: (a is None) == bool(b),
+}
+
+def eval_lookup(instance, lookup, value):
+    """Evaluate a single Django lookup, e.g. ('title__startswith', 'a'),
+    on a model instance in Python.
+    """
+    from .query import MongoDBM2MQueryError
+    parts = lookup.split('__')
+    lookup_type = 'exact'
+    if len(parts) > 1 and parts[-1] in PYTHON_LOOKUPS:
+        lookup_type = parts.pop()
+    if len(parts) != 1:
+        raise MongoDBM2MQueryError(
+            "Unsupported lookup '%s' on embedded objects: related fields "
+            "can't be queried" % lookup)
+    name = parts[0]
+    opts = instance._meta
+    if name in ('pk', opts.pk.name, opts.pk.attname):
+        # pks are compared as ObjectIds
+        def to_id(pk):
+            if isinstance(pk, models.Model):
+                pk = pk.pk
+            return ObjectId(pk) if pk is not None else None
+        attr = to_id(instance.pk)
+        if lookup_type in ('in', 'range'):
+            value = [to_id(pk) for pk in value]
+        elif lookup_type != 'isnull':
+            value = to_id(value)
+    else:
+        try:
+            attname = opts.get_field(name).attname
+        except models.FieldDoesNotExist:
+            raise MongoDBM2MQueryError("Cannot resolve keyword '%s' into "
+                                       "field of %s" % (name, opts.object_name))
+        attr = getattr(instance, attname)
+        if isinstance(value, models.Model):
+            value = value.pk
+    return PYTHON_LOOKUPS[lookup_type](attr, value)
+
+def eval_Q(instance, q):
+    """Evaluate a Q object on a model instance in Python, the way the
+    database would filter it.
+    """
+    results = (eval_Q(instance, child) if isinstance(child, Q)
+               else eval_lookup(instance, child[0], child[1])
+               for child in q.children)
+    if q.connector == Q.OR:
+        result = any(results)
+    else:
+        result = all(results)
+    return not result if q.negated else result
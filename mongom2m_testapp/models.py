@@ -1,6 +1,6 @@
 from django.db import models
 from djangotoolbox.fields import ListField, EmbeddedModelField
-from django_mongom2m.fields import MongoDBManyToManyField
+from django_mongom2m.fields import MongoDBManyToManyField, PULL
 from django_mongodb_engine.contrib import MongoDBManager
 
 class TestCategory(models.Model):
@@ -37,6 +37,17 @@ class TestAuthor(models.Model):
 
 class TestBook(models.Model):
     objects = MongoDBManager()
-    authors = MongoDBManyToManyField(TestAuthor)
+    authors = MongoDBManyToManyField(TestAuthor, atomic=True, on_delete=PULL)
     text = models.TextField()
 
+
+class TestShelf(models.Model):
+    objects = MongoDBManager()
+    books = MongoDBManyToManyField(TestBook, related_name='shelves', storage='collection')
+    name = models.CharField(max_length=254)
+
+
+class TestMagazine(models.Model):
+    objects = MongoDBManager()
+    tags = MongoDBManyToManyField(TestTag, related_name='magazines', embed=True, sync_embedded=True)
+    title = models.CharField(max_length=254)
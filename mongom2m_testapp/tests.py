@@ -1,10 +1,14 @@
 from django.test import TestCase
 from django.db import models
+from django.db.models import Q
 from django.db.models.signals import m2m_changed
-from django_mongom2m.fields import MongoDBManyToManyField
+from django_mongom2m.fields import MongoDBManyToManyField, delete_and_pull
+from django_mongom2m.maintenance import migrate_references, remove_dangling_references
+from django_mongom2m.prefetch import prefetch_mongom2m, with_related, annotate_m2m_counts
+from django_mongom2m.query import MongoDBM2MQueryError
 from django_mongodb_engine.contrib import MongoDBManager
 from djangotoolbox.fields import ListField, EmbeddedModelField
-from models import TestArticle, TestCategory, TestTag, TestAuthor, TestBook#, TestOldArticle, TestOldEmbeddedArticle
+from models import TestArticle, TestCategory, TestTag, TestAuthor, TestBook, TestShelf, TestMagazine#, TestOldArticle, TestOldEmbeddedArticle
 try:
     # ObjectId has been moved to bson.objectid in newer versions of PyMongo
     from bson.objectid import ObjectId
@@ -377,3 +381,850 @@ class MongoDBManyToManyFieldTest(TestCase):
         article.categories.clear()
         self.assertEqual(self.on_clear_called, 2)
         m2m_changed.disconnect(on_clear)
+
+    def test_batched_loading(self):
+        """
+        Test loading non-embedded instances in batches keeps the stored order
+        and skips objects deleted from db.
+        """
+        categories = []
+        for i in range(5):
+            category = TestCategory(title='batch cat %d' % i)
+            category.save()
+            categories.append(category)
+        article = TestArticle(main_category=categories[0], title='batch article', text='batch text')
+        article.save()
+        article.categories.add(*reversed(categories))
+        TestCategory.objects.get(pk=categories[2].pk).delete()
+
+        new_article = TestArticle.objects.get(pk=article.pk)
+        titles = [cat.title for cat in new_article.categories.all()]
+        self.assertEqual(titles, ['batch cat 4', 'batch cat 3', 'batch cat 1', 'batch cat 0'])
+        # Slices are loaded in one go and skip missing objects too
+        new_article = TestArticle.objects.get(pk=article.pk)
+        titles = [cat.title for cat in new_article.categories.all()[1:4]]
+        self.assertEqual(titles, ['batch cat 3', 'batch cat 1'])
+        self.assertIn('batch cat 4', repr(new_article.categories.all()))
+
+    def test_manager_iteration(self):
+        """
+        Test iterating the field directly loads all objects and skips
+        objects deleted from db.
+        """
+        category1 = TestCategory(title='iter cat 1')
+        category1.save()
+        category2 = TestCategory(title='iter cat 2')
+        category2.save()
+        article = TestArticle(main_category=category1, title='iter article', text='iter text')
+        article.save()
+        article.categories.add(category1, category2)
+        TestCategory.objects.get(pk=category1.pk).delete()
+
+        new_article = TestArticle.objects.get(pk=article.pk)
+        self.assertEqual([cat.title for cat in new_article.categories], ['iter cat 2'])
+
+    def test_prefetch(self):
+        """
+        Test prefetching related objects for many hosts at once.
+        """
+        category1 = TestCategory(title='prefetch cat 1')
+        category1.save()
+        category2 = TestCategory(title='prefetch cat 2')
+        category2.save()
+        for i in range(3):
+            article = TestArticle(main_category=category1, title='prefetch article %d' % i, text='prefetch text')
+            article.save()
+            article.categories.add(category1, category2)
+
+        articles = prefetch_mongom2m(TestArticle.objects.filter(title__startswith='prefetch article'), 'categories')
+        self.assertEqual(len(articles), 3)
+        for article in articles:
+            # All related objects are loaded and shared between the hosts
+            self.assertTrue(all(obj.obj for obj in article.categories.objects))
+            self.assertIs(article.categories.objects[0].obj, articles[0].categories.objects[0].obj)
+            self.assertEqual([cat.title for cat in article.categories.all()], ['prefetch cat 1', 'prefetch cat 2'])
+
+    def test_atomic(self):
+        """
+        Test atomic=True only updates the field, not the whole host.
+        """
+        author1 = TestAuthor(name='atomic author 1')
+        author1.save()
+        author2 = TestAuthor(name='atomic author 2')
+        author2.save()
+        book = TestBook(text='atomic text')
+        book.save()
+        # Unsaved changes of the host must not be written by add/remove/clear
+        book.text = 'unsaved text'
+        book.authors.add(author1, author2)
+        self.assertEqual([a.id for a in book.authors.all()], [author1.id, author2.id])
+        new_book = TestBook.objects.get(pk=book.pk)
+        self.assertEqual(new_book.text, 'atomic text')
+        self.assertEqual([a.id for a in new_book.authors.all()], [author1.id, author2.id])
+
+        book.authors.remove(author1)
+        new_book = TestBook.objects.get(pk=book.pk)
+        self.assertEqual([a.id for a in new_book.authors.all()], [author2.id])
+
+        book.authors.clear()
+        new_book = TestBook.objects.get(pk=book.pk)
+        self.assertEqual(new_book.authors.count(), 0)
+        self.assertEqual(new_book.text, 'atomic text')
+
+    def test_ordered_set(self):
+        """
+        Test the related objects behave as an ordered set of pks.
+        """
+        category1 = TestCategory(title='set cat 1')
+        category1.save()
+        category2 = TestCategory(title='set cat 2')
+        category2.save()
+        category3 = TestCategory(title='set cat 3')
+        category3.save()
+        article = TestArticle(main_category=category1, title='set article', text='set text')
+        article.save()
+        article.categories.add(category1, category2, category1, auto_save=False)
+        article.categories.add(category2.id, category3, auto_save=False)
+        self.assertEqual(article.categories.ids(), [ObjectId(category1.id), ObjectId(category2.id), ObjectId(category3.id)])
+        article.categories.remove(category2, auto_save=False)
+        self.assertNotIn(category2, article.categories)
+        self.assertIn(category3.id, article.categories)
+        article.categories.add(category2, auto_save=False)
+        self.assertEqual(article.categories.ids(), [ObjectId(category1.id), ObjectId(category3.id), ObjectId(category2.id)])
+        self.assertEqual(article.categories.all().get(pk=category3.id).title, 'set cat 3')
+        self.assertRaises(TestCategory.DoesNotExist, article.categories.all().get, pk=ObjectId())
+        self.assertEqual(article.categories.all()[1].title, 'set cat 3')
+
+    def test_copy_on_write(self):
+        """
+        Test query sets share the related objects of the field until one of
+        them is modified.
+        """
+        category1 = TestCategory(title='cow cat 1')
+        category1.save()
+        category2 = TestCategory(title='cow cat 2')
+        category2.save()
+        article = TestArticle(main_category=category1, title='cow article', text='cow text')
+        article.save()
+        article.categories.add(category1, auto_save=False)
+        queryset = article.categories.all()
+        self.assertIs(queryset.objects._list, article.categories.objects._list)
+        article.categories.add(category2, auto_save=False)
+        self.assertEqual(queryset.count(), 1)
+        self.assertEqual(article.categories.count(), 2)
+
+    def test_lazy_embedded(self):
+        """
+        Test embedded instances are only built when accessed.
+        """
+        category = TestCategory(title='lazy cat')
+        category.save()
+        tag = TestTag(name='lazy tag')
+        tag.save()
+        article = TestArticle(main_category=category, title='lazy article', text='lazy text')
+        article.save()
+        article.tags.add(tag)
+
+        new_article = TestArticle.objects.get(pk=article.pk)
+        self.assertEqual(new_article.tags.ids(), [ObjectId(tag.id)])
+        self.assertEqual(new_article.tags.count(), 1)
+        self.assertIn(tag, new_article.tags)
+        new_article.save()
+        self.assertIsNotNone(new_article.tags.objects[0].raw)
+        # The instance is built on access
+        self.assertEqual(new_article.tags.all()[0].name, 'lazy tag')
+        self.assertIsNone(new_article.tags.objects[0].raw)
+        # The saved value without building instances is loaded back correctly
+        self.assertEqual(TestArticle.objects.get(pk=article.pk).tags.all()[0].name, 'lazy tag')
+
+    def test_dirty_tracking(self):
+        """
+        Test the field tracks changes to avoid converting unchanged lists.
+        """
+        category = TestCategory(title='dirty cat')
+        category.save()
+        tag = TestTag(name='dirty tag')
+        tag.save()
+        tag2 = TestTag(name='dirty tag 2')
+        tag2.save()
+        article = TestArticle(main_category=category, title='dirty article', text='dirty text')
+        article.save()
+        article.categories.add(category)
+        article.tags.add(tag, tag2)
+        self.assertFalse(article.categories.is_dirty())
+
+        new_article = TestArticle.objects.get(pk=article.pk)
+        self.assertFalse(new_article.categories.is_dirty())
+        self.assertFalse(new_article.tags.is_dirty())
+        db_value = new_article.categories._db_value
+        tags_db_value = new_article.tags._db_value
+        self.assertEqual(len(tags_db_value), 2)
+        new_article.title = 'new dirty article'
+        new_article.save()
+        self.assertIs(new_article.categories._db_value, db_value)
+        self.assertIs(new_article.tags._db_value, tags_db_value)
+        # Only the accessed embedded instance is converted again
+        new_article.tags.objects[1].obj.name = 'changed dirty tag 2'
+        self.assertIsNotNone(new_article.tags.objects[0].raw)
+        new_article.save()
+        self.assertIs(new_article.tags._db_value, tags_db_value)
+        self.assertFalse(new_article.tags.is_dirty())
+        self.assertEqual([t.name for t in TestArticle.objects.get(pk=article.pk).tags.all()],
+                         ['dirty tag', 'changed dirty tag 2'])
+        new_article.categories.remove(category, auto_save=False)
+        self.assertTrue(new_article.categories.is_dirty())
+        new_article.save()
+        new_article = TestArticle.objects.get(pk=article.pk)
+        self.assertEqual(new_article.title, 'new dirty article')
+        self.assertEqual(new_article.categories.count(), 0)
+        self.assertEqual(new_article.tags.all()[0].name, 'dirty tag')
+
+    def test_embed_unloaded(self):
+        """
+        Test saving embedded objects added by id loads them from db.
+        """
+        category = TestCategory(title='unloaded cat')
+        category.save()
+        tag1 = TestTag(name='unloaded tag 1')
+        tag1.save()
+        tag2 = TestTag(name='unloaded tag 2')
+        tag2.save()
+        article = TestArticle(main_category=category, title='unloaded article', text='unloaded text')
+        article.save()
+        article.tags.add(tag1.id, ObjectId(tag2.id))
+        new_article = TestArticle.objects.get(pk=article.pk)
+        self.assertEqual([tag.name for tag in new_article.tags.all()], ['unloaded tag 1', 'unloaded tag 2'])
+
+    def test_reload_from_db(self):
+        """
+        Test reload_from_db refreshes embedded copies and only removes (and
+        signals) objects deleted from db.
+        """
+        category = TestCategory(title='reload cat')
+        category.save()
+        tag1 = TestTag(name='reload tag 1')
+        tag1.save()
+        tag2 = TestTag(name='reload tag 2')
+        tag2.save()
+        article = TestArticle(main_category=category, title='reload article', text='reload text')
+        article.save()
+        article.tags.add(tag1, tag2)
+        tag1.name = 'reloaded tag 1'
+        tag1.save()
+        TestTag.objects.get(pk=tag2.pk).delete()
+
+        self.actions = []
+        def on_change(sender, instance, action, reverse, model, pk_set, *args, **kwargs):
+            self.actions.append((action, list(pk_set)))
+        m2m_changed.connect(on_change)
+        new_article = TestArticle.objects.get(pk=article.pk)
+        new_article.title = 'unsaved title'
+        new_article.tags.reload_from_db()
+        m2m_changed.disconnect(on_change)
+        self.assertEqual(self.actions, [('pre_remove', [str(tag2.id)]), ('post_remove', [str(tag2.id)])])
+
+        new_article = TestArticle.objects.get(pk=article.pk)
+        self.assertEqual(new_article.title, 'reload article')
+        self.assertEqual([tag.name for tag in new_article.tags.all()], ['reloaded tag 1'])
+
+    def test_update_embedded_copies(self):
+        """
+        Test updating the embedded copies of a related object in all hosts.
+        """
+        category = TestCategory(title='sync cat')
+        category.save()
+        tag1 = TestTag(name='sync tag 1')
+        tag1.save()
+        tag2 = TestTag(name='sync tag 2')
+        tag2.save()
+        for i in range(2):
+            article = TestArticle(main_category=category, title='sync article %d' % i, text='sync text')
+            article.save()
+            article.tags.add(tag1, tag2)
+        tag2.name = 'synced tag 2'
+        tag2.save()
+        TestArticle._meta.get_field('tags').update_embedded_copies(tag2)
+        for article in TestArticle.objects.filter(title__startswith='sync article'):
+            self.assertEqual([tag.name for tag in article.tags.all()], ['sync tag 1', 'synced tag 2'])
+
+        # With sync_embedded=True, saving the related object updates the copies
+        magazine = TestMagazine(title='sync magazine')
+        magazine.save()
+        magazine.tags.add(tag1, tag2)
+        tag1.name = 'synced tag 1'
+        tag1.save()
+        magazine = TestMagazine.objects.get(pk=magazine.pk)
+        self.assertEqual([tag.name for tag in magazine.tags.all()], ['synced tag 1', 'synced tag 2'])
+
+    def test_on_delete_pull(self):
+        """
+        Test ids of deleted objects are pulled from hosts with on_delete=PULL.
+        """
+        authors = []
+        for i in range(4):
+            author = TestAuthor(name='pull author %d' % i)
+            author.save()
+            authors.append(author)
+        book1 = TestBook(text='pull book 1')
+        book1.save()
+        book1.authors.add(*authors)
+        book2 = TestBook(text='pull book 2')
+        book2.save()
+        book2.authors.add(authors[0], authors[3])
+
+        TestAuthor.objects.get(pk=authors[0].pk).delete()
+        self.assertEqual(TestBook.objects.get(pk=book1.pk).authors.ids(), [ObjectId(a.id) for a in authors[1:]])
+        self.assertEqual(TestBook.objects.get(pk=book2.pk).authors.ids(), [ObjectId(authors[3].id)])
+
+        delete_and_pull(TestAuthor.objects.filter(name__in=['pull author 1', 'pull author 3']))
+        self.assertEqual(TestBook.objects.get(pk=book1.pk).authors.ids(), [ObjectId(authors[2].id)])
+        self.assertEqual(TestBook.objects.get(pk=book2.pk).authors.count(), 0)
+
+    def test_remove_dangling_references(self):
+        """
+        Test removing ids of deleted objects from all hosts in batches.
+        """
+        category1 = TestCategory(title='gc cat 1')
+        category1.save()
+        category2 = TestCategory(title='gc cat 2')
+        category2.save()
+        articles = []
+        for i in range(3):
+            article = TestArticle(main_category=category1, title='gc article %d' % i, text='gc text')
+            article.save()
+            article.categories.add(category1, category2)
+            articles.append(article)
+        TestCategory.objects.get(pk=category2.pk).delete()
+        field = TestArticle._meta.get_field('categories')
+        # A legacy raw id, as stored by ListField(ForeignKey)
+        from django.db import connections
+        connections['default'].get_collection(TestArticle._meta.db_table).update_one(
+            {'_id': ObjectId(articles[2].pk)}, {'$push': {'categories': str(category2.pk)}})
+
+        report = remove_dangling_references(field, batch_size=2, dry_run=True)
+        self.assertEqual(report['hosts_changed'], 3)
+        # Referenced in both batches, counted once
+        self.assertEqual(report['dangling'], 1)
+        self.assertEqual(TestArticle.objects.get(pk=articles[0].pk).categories.count(), 2)
+
+        report = remove_dangling_references(field, batch_size=2, start_after=articles[0].pk)
+        self.assertEqual(report['hosts_changed'], 2)
+        self.assertEqual(TestArticle.objects.get(pk=articles[0].pk).categories.count(), 2)
+        for article in articles[1:]:
+            self.assertEqual(TestArticle.objects.get(pk=article.pk).categories.ids(), [ObjectId(category1.id)])
+
+    def test_migrate_references(self):
+        """
+        Test migrating from ListField(ForeignKey) fields in bulk.
+        """
+        category1 = TestCategory(title='bulk cat 1')
+        category1.save()
+        tag1 = TestTag(name='bulk tag 1')
+        tag1.save()
+        tag2 = TestTag(name='bulk tag 2')
+        tag2.save()
+
+        class TestBulkOldArticle(models.Model):
+            class Meta:
+                db_table = TestArticle._meta.db_table
+            objects = MongoDBManager()
+            main_category = models.ForeignKey(TestCategory, related_name='main_bulkoldarticles')
+            categories = ListField(models.ForeignKey(TestCategory))
+            tags = ListField(models.ForeignKey(TestTag))
+            title = models.CharField(max_length=254)
+            text = models.TextField()
+
+        old_article = TestBulkOldArticle(title='bulk old article', text='bulk text', main_category=category1, categories=[category1.id], tags=[tag1.id, tag2.id])
+        old_article.save()
+        # An entry without id is left unchanged
+        from django.db import connections
+        collection = connections['default'].get_collection(TestArticle._meta.db_table)
+        collection.update_one({'_id': ObjectId(old_article.pk)}, {'$push': {'categories': {'title': 'no id'}}})
+
+        for name in ('categories', 'tags'):
+            report = migrate_references(TestArticle._meta.get_field(name), batch_size=1)
+            self.assertEqual(report['hosts_changed'], 1)
+            self.assertEqual(report['unmigrated'], 1 if name == 'categories' else 0)
+
+        document = collection.find_one({'_id': ObjectId(old_article.pk)})
+        self.assertEqual(document['categories'], [{'id': ObjectId(category1.id)}, {'title': 'no id'}])
+        collection.update_one({'_id': ObjectId(old_article.pk)}, {'$pull': {'categories': {'title': 'no id'}}})
+        self.assertEqual([tag['name'] for tag in document['tags']], ['bulk tag 1', 'bulk tag 2'])
+        article = TestArticle.objects.get(pk=old_article.pk)
+        self.assertEqual([tag.name for tag in article.tags.all()], ['bulk tag 1', 'bulk tag 2'])
+        self.assertFalse(article.tags.is_dirty())
+
+    def test_queryset_filter(self):
+        """
+        Test filter/exclude/order_by/count/exists on the related objects,
+        in db for non-embedded objects and in memory for embedded ones.
+        """
+        category1 = TestCategory(title='filter cat a')
+        category1.save()
+        category2 = TestCategory(title='filter cat b')
+        category2.save()
+        category3 = TestCategory(title='other cat')
+        category3.save()
+        tag1 = TestTag(name='filter tag a')
+        tag1.save()
+        tag2 = TestTag(name='filter tag b')
+        tag2.save()
+        article = TestArticle(main_category=category1, title='filter article', text='filter text')
+        article.save()
+        article.categories.add(category2, category1, category3)
+        article.tags.add(tag2, tag1)
+
+        article = TestArticle.objects.get(pk=article.pk)
+        for manager, prefix in ((article.categories, 'filter cat'), (article.tags, 'filter tag')):
+            field = 'title' if manager is article.categories else 'name'
+            objects = manager.all().filter(**{field + '__startswith': 'filter'})
+            self.assertEqual([getattr(obj, field) for obj in objects], [prefix + ' b', prefix + ' a'])
+            self.assertEqual(objects.count(), 2)
+            self.assertTrue(objects.exists())
+            ordered = manager.all().filter(**{field + '__startswith': 'filter'}).order_by(field)
+            self.assertEqual([getattr(obj, field) for obj in ordered], [prefix + ' a', prefix + ' b'])
+            excluded = manager.all().exclude(**{field: prefix + ' a'})
+            self.assertNotIn(prefix + ' a', [getattr(obj, field) for obj in excluded])
+            self.assertFalse(manager.all().filter(**{field: 'nothing'}).exists())
+        self.assertEqual(article.categories.all().get(title='other cat'), category3)
+        self.assertEqual(article.categories.all().filter(title='other cat').get(), category3)
+        self.assertEqual(article.tags.all().filter(name='filter tag a').get(), tag1)
+        self.assertRaises(TestCategory.MultipleObjectsReturned,
+                          article.categories.all().filter(title__startswith='filter').get)
+        self.assertRaises(TestCategory.DoesNotExist,
+                          article.categories.all().filter(title='nothing').get)
+        self.assertEqual(article.tags.all().filter(pk=tag1.pk).count(), 1)
+        # Filters don't change the manager
+        self.assertEqual(article.categories.count(), 3)
+
+        # The related ids are sent in chunks of chunk_size
+        rel = TestArticle._meta.get_field('categories').rel
+        chunk_size, rel.chunk_size = rel.chunk_size, 1
+        try:
+            ordered = article.categories.all().exclude(title='nothing').order_by('-title')
+            self.assertEqual([c.title for c in ordered], ['other cat', 'filter cat b', 'filter cat a'])
+            self.assertEqual(article.categories.all().filter(title__startswith='filter').count(), 2)
+        finally:
+            rel.chunk_size = chunk_size
+
+    def test_values(self):
+        """
+        Test values_list/values/only on the related objects load only the
+        requested fields, and pks need no query.
+        """
+        category1 = TestCategory(title='values cat 1')
+        category1.save()
+        category2 = TestCategory(title='values cat 2')
+        category2.save()
+        tag = TestTag(name='values tag')
+        tag.save()
+        article = TestArticle(main_category=category1, title='values article', text='values text')
+        article.save()
+        article.categories.add(category2, category1)
+        article.tags.add(tag)
+        TestCategory.objects.get(pk=category1.pk).delete()
+
+        article = TestArticle.objects.get(pk=article.pk)
+        # The ids are known without loading the objects
+        self.assertEqual(list(article.categories.all().values_list('pk', flat=True)), [category2.pk, category1.pk])
+        self.assertEqual(list(article.categories.all().values_list('pk', flat=True, exists_in_db_only=True)), [category2.pk])
+        self.assertEqual(list(article.categories.all().values_list('title', flat=True)), ['values cat 2'])
+        self.assertEqual(list(article.categories.all().values('pk', 'title')), [{'pk': category2.pk, 'title': 'values cat 2'}])
+        self.assertEqual(list(article.tags.all().values_list('id', 'name')), [(tag.pk, 'values tag')])
+        categories = list(article.categories.all().only('title'))
+        self.assertEqual([category.title for category in categories], ['values cat 2'])
+        # Deferred instances don't end up in the cache of the manager
+        self.assertEqual(article.categories.objects.get(ObjectId(category2.pk)).obj, None)
+
+    def test_lazy_manager(self):
+        """
+        Test a deferred field loads only the requested windows of the list,
+        and the whole list only when needed.
+        """
+        categories = []
+        for i in range(5):
+            category = TestCategory(title='lazy cat %d' % i)
+            category.save()
+            categories.append(category)
+        article = TestArticle(main_category=categories[0], title='lazy article', text='lazy text')
+        article.save()
+        article.categories.add(*categories)
+
+        article = TestArticle.objects.defer('categories').get(pk=article.pk)
+        self.assertFalse(article.categories.is_loaded())
+        self.assertEqual(article.categories.count(), 5)
+        self.assertEqual(len(article.categories.all()), 5)
+        self.assertEqual([cat.title for cat in article.categories.all()[1:3]], ['lazy cat 1', 'lazy cat 2'])
+        self.assertEqual(article.categories.all()[4].title, 'lazy cat 4')
+        self.assertEqual([cat.title for cat in article.categories.all(offset=3, limit=5)], ['lazy cat 3', 'lazy cat 4'])
+        self.assertEqual(article.categories.ids(), [ObjectId(cat.pk) for cat in categories])
+        self.assertTrue(categories[2] in article.categories)
+        self.assertFalse(article.categories.is_loaded())
+        # Saving the host doesn't touch the list
+        article.title = 'lazy article 2'
+        article.save()
+        self.assertFalse(article.categories.is_loaded())
+        # Iterating loads the list
+        self.assertEqual([cat.title for cat in article.categories.all()], ['lazy cat %d' % i for i in range(5)])
+        self.assertTrue(article.categories.is_loaded())
+        article.categories.remove(categories[0])
+        article = TestArticle.objects.get(pk=article.pk)
+        self.assertEqual(article.title, 'lazy article 2')
+        self.assertEqual(article.categories.count(), 4)
+        # Loaded managers are sliced in memory
+        self.assertEqual([cat.title for cat in article.categories.all(offset=1, limit=1)], ['lazy cat 2'])
+
+    def test_edge_storage(self):
+        """
+        Test storing the relations in an edge collection.
+        """
+        books = []
+        for i in range(4):
+            book = TestBook(text='edge book %d' % i)
+            book.save()
+            books.append(book)
+        # Relations added before saving are written with the host
+        shelf = TestShelf(name='edge shelf')
+        shelf.books.add(books[0], auto_save=False)
+        shelf.save()
+        shelf.books.add(books[1], books[2])
+        shelf.books.add(books[1])
+
+        from django.db import connections
+        document = connections['default'].get_collection(TestShelf._meta.db_table).find_one({'_id': ObjectId(shelf.pk)})
+        self.assertEqual(document.get('books'), None)
+        edges = connections['default'].get_collection(TestShelf.books.field.rel.edges.name)
+        self.assertEqual(edges.count_documents({'host_id': ObjectId(shelf.pk)}), 3)
+
+        shelf = TestShelf.objects.get(pk=shelf.pk)
+        self.assertFalse(shelf.books.is_loaded())
+        self.assertEqual(shelf.books.count(), 3)
+        self.assertEqual(shelf.books.ids(), [ObjectId(book.pk) for book in books[:3]])
+        self.assertTrue(books[1] in shelf.books)
+        self.assertFalse(books[3] in shelf.books)
+        self.assertEqual([book.text for book in shelf.books.all()[1:]], ['edge book 1', 'edge book 2'])
+        self.assertEqual(list(books[1].shelves.all()), [shelf])
+        self.assertEqual(books[1].shelves.all().count(), 1)
+        self.assertEqual(list(books[1].shelves.all().filter(name='edge shelf')), [shelf])
+        self.assertEqual(list(books[1].shelves.all().exclude(name='edge shelf')), [])
+        self.assertEqual(list(TestShelf.books.filter(pk=books[2])), [shelf])
+
+        # Lazy managers write the edges without loading the objects
+        shelf.books.remove(books[1])
+        self.assertFalse(shelf.books.is_loaded())
+        shelf.books.add(books[0], books[3])
+        self.assertFalse(shelf.books.is_loaded())
+        self.assertEqual(shelf.books.ids(), [ObjectId(book.pk) for book in (books[0], books[2], books[3])])
+        shelf.books.remove(books[3])
+        shelf = TestShelf.objects.get(pk=shelf.pk)
+        self.assertEqual([book.text for book in shelf.books.all()], ['edge book 0', 'edge book 2'])
+        self.assertEqual(list(books[1].shelves.all()), [])
+        # Saving the host doesn't rewrite the edges
+        shelf.name = 'edge shelf 2'
+        shelf.save()
+        self.assertEqual(TestShelf.objects.get(pk=shelf.pk).books.count(), 2)
+
+        # Saving pending changes only writes the edges added and removed
+        kept = edges.find_one({'host_id': ObjectId(shelf.pk), 'related_id': ObjectId(books[0].pk)})
+        shelf = TestShelf.objects.get(pk=shelf.pk)
+        shelf.books = [books[0], books[2], books[3]]
+        shelf.books.remove(books[2], auto_save=False)
+        shelf.save()
+        self.assertEqual(edges.find_one({'host_id': ObjectId(shelf.pk), 'related_id': ObjectId(books[0].pk)}), kept)
+        self.assertEqual(TestShelf.objects.get(pk=shelf.pk).books.ids(), [ObjectId(books[0].pk), ObjectId(books[3].pk)])
+        # The positions are allocated atomically, never twice
+        positions = [edge['position'] for edge in edges.find({'host_id': ObjectId(shelf.pk)})]
+        self.assertEqual(len(set(positions)), len(positions))
+        shelf.books.remove(books[3])
+
+        shelf = prefetch_mongom2m(TestShelf.objects.filter(pk=shelf.pk), 'books')[0]
+        self.assertTrue(shelf.books.is_loaded())
+        self.assertEqual(len(shelf.books.all()), 1)
+
+        shelf.books.clear()
+        self.assertEqual(TestShelf.objects.get(pk=shelf.pk).books.count(), 0)
+        shelf.books.add(books[3])
+        TestShelf.objects.get(pk=shelf.pk).delete()
+        self.assertEqual(edges.count_documents({'host_id': ObjectId(shelf.pk)}), 0)
+
+    def test_reverse_queries(self):
+        """
+        Test the reverse manager queries run by the database, and the paged
+        relationship query set.
+        """
+        category1 = TestCategory(title='reverse cat 1')
+        category1.save()
+        category2 = TestCategory(title='reverse cat 2')
+        category2.save()
+        articles = []
+        for i in range(3):
+            article = TestArticle(main_category=category1, title='reverse article %d' % i, text='reverse text')
+            article.save()
+            article.categories.add(category1)
+            articles.append(article)
+
+        self.assertEqual(category1.testarticle_set.count(), 3)
+        self.assertTrue(category1.testarticle_set.exists())
+        self.assertFalse(category2.testarticle_set.exists())
+        self.assertEqual(sorted(category1.testarticle_set.ids()), sorted(ObjectId(article.pk) for article in articles))
+        self.assertEqual(sorted(category1.testarticle_set.values_list('title', flat=True)), ['reverse article 0', 'reverse article 1', 'reverse article 2'])
+        self.assertEqual(sorted(category1.testarticle_set.values_list('pk', 'main_category')), sorted((article.pk, category1.pk) for article in articles))
+
+        through = TestArticle.categories.through
+        relationships = through.objects.filter(testcategory=category1)
+        self.assertEqual(len(relationships), 3)
+        self.assertEqual(relationships.count(), 3)
+        self.assertEqual(sorted(rel.testarticle.title for rel in relationships[1:]), ['reverse article 1', 'reverse article 2'])
+        self.assertEqual(len(list(relationships)), 3)
+        self.assertEqual(relationships.get(pk=articles[0].pk).testarticle, articles[0])
+
+        # The relationships are iterated by _id ranges of chunk_size hosts
+        rel = TestArticle._meta.get_field('categories').rel
+        chunk_size, rel.chunk_size = rel.chunk_size, 2
+        try:
+            self.assertEqual([r.testarticle.pk for r in through.objects.filter(testcategory=category1)],
+                             sorted(article.pk for article in articles))
+            self.assertEqual(sorted(through.objects.filter(testcategory=category1).values_list('pk', flat=True)),
+                             sorted(article.pk for article in articles))
+        finally:
+            rel.chunk_size = chunk_size
+
+        # With storage='collection', edges of missing hosts don't stop the scan
+        book = TestBook(text='reverse book')
+        book.save()
+        shelves = []
+        for i in range(3):
+            shelf = TestShelf(name='reverse shelf %d' % i)
+            shelf.save()
+            shelf.books.add(book)
+            shelves.append(shelf)
+        from django.db import connections
+        connections['default'].get_collection(TestShelf._meta.db_table).delete_one({'_id': ObjectId(shelves[0].pk)})
+        windows = list(book.shelves._iter_windows(1))
+        self.assertEqual([obj.pk for window in windows for obj in window],
+                         [ObjectId(shelf.pk) for shelf in shelves[1:]])
+
+    def test_reverse_iterator(self):
+        """
+        Test iterating the reverse relation straight from a cursor.
+        """
+        category = TestCategory(title='iterator cat')
+        category.save()
+        tag = TestTag(name='iterator tag')
+        tag.save()
+        for i in range(3):
+            article = TestArticle(main_category=category, title='iterator article %d' % i, text='iterator text')
+            article.save()
+            article.categories.add(category)
+            article.tags.add(tag)
+
+        articles = list(category.testarticle_set.iterator(batch_size=2))
+        self.assertEqual(sorted(article.title for article in articles), ['iterator article 0', 'iterator article 1', 'iterator article 2'])
+        # The M2M fields are deferred and loaded when accessed
+        self.assertFalse(articles[0].tags.is_loaded())
+        self.assertEqual([t.name for t in articles[0].tags.all()], ['iterator tag'])
+        self.assertEqual(articles[0].main_category, category)
+
+        articles = list(category.testarticle_set.iterator(projection=['title']))
+        self.assertEqual(len(articles), 3)
+        self.assertTrue(articles[0].title.startswith('iterator article'))
+        self.assertEqual(articles[0].text, 'iterator text') # deferred field loaded by Django
+
+    def test_set_queries(self):
+        """
+        Test querying the hosts by sets and number of related objects.
+        """
+        category = TestCategory(title='set cat')
+        category.save()
+        tags = []
+        for i in range(3):
+            tag = TestTag(name='set tag %d' % i)
+            tag.save()
+            tags.append(tag)
+        article1 = TestArticle(main_category=category, title='set article 1', text='set text')
+        article1.save()
+        article1.tags.add(*tags)
+        article2 = TestArticle(main_category=category, title='set article 2', text='set text')
+        article2.save()
+        article2.tags.add(tags[0])
+        article3 = TestArticle(main_category=category, title='set article 3', text='set text')
+        article3.save()
+
+        def titles(queryset):
+            return sorted(article.title for article in queryset.filter_host(main_category=category))
+        self.assertEqual(titles(TestArticle.tags.filter_all([tags[0], tags[1]])), ['set article 1'])
+        self.assertEqual(titles(TestArticle.tags.filter_any([tags[0].pk])), ['set article 1', 'set article 2'])
+        self.assertEqual(titles(TestArticle.tags.filter_none([tags[1]])), ['set article 2', 'set article 3'])
+        self.assertEqual(titles(TestArticle.tags.filter_size(0)), ['set article 3'])
+        self.assertEqual(titles(TestArticle.tags.filter_size(1)), ['set article 2'])
+        self.assertEqual(titles(TestArticle.tags.filter_size(gt=1)), ['set article 1'])
+        self.assertEqual(titles(TestArticle.tags.filter_size(gte=1, lte=2)), ['set article 2'])
+        self.assertEqual(titles(TestArticle.tags.filter_size(lt=3)), ['set article 2', 'set article 3'])
+        self.assertEqual(titles(TestArticle.tags.filter_size(gt=3)), [])
+
+        # Non-embedded ids
+        article1.categories.add(category)
+        article2.categories.add(category)
+        self.assertEqual(titles(TestArticle.categories.filter_all([category])), ['set article 1', 'set article 2'])
+        self.assertEqual(titles(TestArticle.categories.filter_any([category.pk])), ['set article 1', 'set article 2'])
+        self.assertEqual(titles(TestArticle.categories.filter_none([category])), ['set article 3'])
+        self.assertEqual(titles(TestArticle.categories.filter_size(0)), ['set article 3'])
+        self.assertEqual(titles(TestArticle.categories.filter_size(gte=1)), ['set article 1', 'set article 2'])
+
+        # Not supported by the edge storage
+        book = TestBook(text='set book')
+        book.save()
+        for method, args in (('filter_all', ([book],)), ('filter_any', ([book],)),
+                             ('filter_none', ([book],)), ('filter_size', (1,))):
+            self.assertRaises(MongoDBM2MQueryError, getattr(TestShelf.books, method), *args)
+
+    def test_elem_match(self):
+        """
+        Test matching all the conditions on the same embedded object.
+        """
+        category = TestCategory(title='elem cat')
+        category.save()
+        tag1 = TestTag(name='elem tag a')
+        tag1.save()
+        tag2 = TestTag(name='elem tag b')
+        tag2.save()
+        article = TestArticle(main_category=category, title='elem article', text='elem text')
+        article.save()
+        article.tags.add(tag1, tag2)
+
+        # The conditions are matched by different tags
+        self.assertEqual(TestArticle.tags.filter(name='elem tag a', pk=tag2).count(), 1)
+        self.assertEqual(TestArticle.tags.filter(name='elem tag a', pk=tag2, elem_match=True).count(), 0)
+        self.assertEqual(TestArticle.tags.filter(name='elem tag a', pk=tag1, elem_match=True).count(), 1)
+        self.assertEqual(TestArticle.tags.filter(Q(name__startswith='elem tag a', pk=tag2) | Q(name='x'), elem_match=True).count(), 0)
+        self.assertEqual(TestArticle.tags.get(name__istartswith='ELEM TAG', name__endswith='b', elem_match=True), article)
+        self.assertEqual(TestArticle.tags.filter(name__in=['elem tag b', 'x'], elem_match=True).count(), 1)
+        self.assertEqual(TestArticle.tags.filter(name__contains='tag', elem_match=True).filter_host(pk=article.pk).count(), 1)
+        self.assertEqual(TestArticle.tags.exclude(name__contains='tag', elem_match=True).filter_host(pk=article.pk).count(), 0)
+        self.assertEqual(TestArticle.categories.filter(pk__in=[category], elem_match=True).filter_host(pk=article.pk).count(), 0)
+        self.assertRaises(MongoDBM2MQueryError, TestArticle.categories.filter, title='elem cat', elem_match=True)
+        # Empty conditions match everything, $ matches the end of the value only
+        self.assertEqual(TestArticle.tags.filter(Q(), elem_match=True).filter_host(pk=article.pk).count(), 1)
+        self.assertEqual(TestArticle.tags.exclude(Q(), elem_match=True).filter_host(pk=article.pk).count(), 1)
+        tag3 = TestTag(name='elem tag c\n')
+        tag3.save()
+        article.tags.add(tag3)
+        self.assertEqual(TestArticle.tags.filter(name__endswith='c', elem_match=True).count(), 0)
+        self.assertEqual(TestArticle.tags.filter(name__iexact='ELEM TAG C\n', elem_match=True).count(), 1)
+        # Values of text lookups are matched as strings
+        tag4 = TestTag(name='elem tag 42')
+        tag4.save()
+        article.tags.add(tag4)
+        self.assertEqual(TestArticle.tags.filter(name__endswith=42, elem_match=True).count(), 1)
+        self.assertRaises(ValueError, TestArticle.tags.filter, name__contains=None, elem_match=True)
+
+    def test_chained_queries(self):
+        """
+        Test chaining M2M-aware queries and host queries into one query.
+        """
+        category = TestCategory(title='chain cat')
+        category.save()
+        tag1 = TestTag(name='chain tag a')
+        tag1.save()
+        tag2 = TestTag(name='chain tag b')
+        tag2.save()
+        articles = []
+        for i in range(3):
+            article = TestArticle(main_category=category, title='chain article %d' % i, text='chain text')
+            article.save()
+            articles.append(article)
+        articles[0].tags.add(tag1, tag2)
+        articles[1].tags.add(tag1)
+        articles[2].tags.add(tag2)
+        articles[0].categories.add(category)
+        articles[0].save()
+        articles[1].categories.add(category)
+        articles[1].save()
+
+        queryset = TestArticle.tags.filter(name='chain tag a')
+        # The chained filters and excludes act on the related objects
+        self.assertEqual([a.title for a in queryset.exclude(name='chain tag b')], ['chain article 1'])
+        self.assertEqual(queryset.filter(pk=tag2).count(), 1)
+        self.assertEqual([a.title for a in queryset.filter_host(title__endswith='1')], ['chain article 1'])
+        self.assertEqual([a.title for a in queryset.exclude_host(title__endswith='1')], ['chain article 0'])
+        ordered = queryset.filter_host(main_category=category).order_by('-title')
+        self.assertEqual([a.title for a in ordered], ['chain article 1', 'chain article 0'])
+        self.assertEqual([a.title for a in ordered.limit(1)], ['chain article 1'])
+        self.assertEqual(ordered.filter_size(1).get(), articles[1])
+        self.assertEqual(TestArticle.tags.filter_any([tag2]).filter_size(1).get(), articles[2])
+        self.assertEqual(TestArticle.tags.all().filter_host(main_category=category).none().count(), 0)
+        # The query is a single MongoDB query
+        self.assertEqual(queryset.filter_host(pk=articles[0].pk).get_query(),
+                         {'$and': [{'tags.name': 'chain tag a'}, {'_id': ObjectId(articles[0].pk)}]})
+        self.assertTrue(ordered.limit(1).explain())
+        # Non-embedded fields can only be filtered by pk
+        self.assertEqual(TestArticle.categories.filter(pk=category).filter_host(main_category=category).count(), 2)
+        self.assertRaises(MongoDBM2MQueryError, TestArticle.categories.all().filter, title='chain cat')
+
+    def test_with_related(self):
+        """
+        Test loading the hosts and their related objects with one aggregation.
+        """
+        main_category = TestCategory(title='join main cat')
+        main_category.save()
+        categories = []
+        for i in range(3):
+            category = TestCategory(title='join cat %d' % i)
+            category.save()
+            categories.append(category)
+        article1 = TestArticle(main_category=main_category, title='join article 1', text='join text')
+        article1.save()
+        article1.categories.add(categories[2], categories[0])
+        article1.save()
+        article2 = TestArticle(main_category=main_category, title='join article 2', text='join text')
+        article2.save()
+        article2.categories.add(categories[1])
+        article2.save()
+
+        queryset = TestArticle.categories.all().filter_host(main_category=main_category).order_by('title')
+        articles = with_related(queryset, 'categories')
+        self.assertEqual([a.title for a in articles], ['join article 1', 'join article 2'])
+        # The related objects are loaded in the stored order
+        self.assertTrue(all(obj.obj for article in articles for obj in article.categories.objects))
+        self.assertEqual([c.title for c in articles[0].categories.all()], ['join cat 2', 'join cat 0'])
+        self.assertEqual([c.title for c in articles[1].categories.all()], ['join cat 1'])
+
+        articles = queryset.limit(1).with_related('categories', only={'categories': ['title']})
+        self.assertEqual(len(articles), 1)
+        category = articles[0].categories.objects[0].obj
+        self.assertEqual(category.title, 'join cat 2')
+        self.assertEqual(category.pk, categories[2].pk)
+        self.assertRaises(ValueError, with_related, TestArticle, 'title')
+        self.assertRaises(ValueError, with_related, TestShelf, 'books')
+
+    def test_annotate_m2m_counts(self):
+        """
+        Test counting the hosts of many related objects with one aggregation.
+        """
+        main_category = TestCategory(title='count main cat')
+        main_category.save()
+        categories = []
+        for i in range(3):
+            category = TestCategory(title='count cat %d' % i)
+            category.save()
+            categories.append(category)
+        for i in range(3):
+            article = TestArticle(main_category=main_category, title='count article %d' % i, text='count text')
+            article.save()
+            article.categories.add(*categories[:i + 1])
+            article.save()
+
+        annotated = annotate_m2m_counts(TestCategory.objects.filter(title__startswith='count cat'), TestArticle.categories)
+        self.assertEqual(sorted((c.title, c.testarticle_set_count) for c in annotated),
+                         [('count cat 0', 3), ('count cat 1', 2), ('count cat 2', 1)])
+        annotate_m2m_counts([main_category], TestArticle._meta.get_field('categories'), attr='articles')
+        self.assertEqual(main_category.articles, 0)
+
+        books = [TestBook(text='count book %d' % i) for i in range(2)]
+        for book in books:
+            book.save()
+        shelf = TestShelf(name='count shelf')
+        shelf.save()
+        shelf.books.add(books[0])
+        annotate_m2m_counts(books, TestShelf.books)
+        self.assertEqual([book.shelves_count for book in books], [1, 0])
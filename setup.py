@@ -5,7 +5,8 @@ setup(
     version='0.2.2',
     author=u'Merchant Atlas Inc.',
     author_email='support@merchantatlas.com',
-    packages=['django_mongom2m'],
+    packages=['django_mongom2m', 'django_mongom2m.management',
+              'django_mongom2m.management.commands'],
     url='https://github.com/mobilespinach/django-mongom2m',
     license='BSD licence, see LICENCE.txt',
     description='A ManyToManyField for django-mongodb-engine',